@@ -0,0 +1,426 @@
+"""Навантажувальний тест бота без Telegram: фейковий Bot API, одноразовий Postgres, синтетичні користувачі.
+
+Кожен користувач проходить start → checkin → ci_N → w_🟢 → team → checkout → co_N через той самий
+Application, що й у проді (build_application, post_init/post_stop/post_shutdown). Bot API замінює
+локальний сервер: він записує виклики, додає затримку і з заданою ймовірністю відповідає 429 RetryAfter.
+
+Звіт: p50/p95/p99 обробки оновлення (загалом і по кроках), DB-хелпери і виклики Telegram на оновлення.
+Результат дописується в benchmarks/results/loadtest.jsonl з хешем коміту і порівнюється з попереднім
+запуском з тими ж параметрами.
+
+    python benchmarks/loadtest.py --users 2000 --concurrency 200 --api-ms 30 --retry-after-rate 0.005
+
+Postgres піднімається через initdb/pg_ctl (з PATH або PG_BIN) у тимчасовому каталозі і видаляється після
+тесту; initdb не працює від root - тоді передай --database-url на порожню одноразову БД.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime, timezone
+from time import monotonic, time
+from urllib.parse import parse_qsl
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+RESULTS_PATH = os.path.join(ROOT, 'benchmarks', 'results', 'loadtest.jsonl')
+TOKEN = '123456:LOADTEST'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+FIRST_USER_ID = 10_000_000
+STEPS = ('start', 'checkin', 'ci', 'workload', 'team', 'checkout', 'co')
+# Порівнюються між запусками: менше - краще, крім updates_per_second
+COMPARED = ('updates_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'db_calls_per_update', 'telegram_calls_per_update')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotAPI:
+    """Замінник api.telegram.org: записує виклики, додає затримку і зрідка відповідає 429"""
+    def __init__(self, latency_ms, jitter_ms, retry_after_rate, retry_after):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.retry_afters = 0
+        self._message_id = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}'
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+                method = target.split('?', 1)[0].rsplit('/', 1)[-1]
+                status, payload = await self.respond(method, self._params(headers, body))
+                data = json.dumps(payload).encode()
+                writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _params(headers, body):
+        """PTB шле form-urlencoded, де складні значення - JSON; multipart (файли) тут не потрібен"""
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params = {}
+            for key, value in parse_qsl(body.decode()):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+            return params
+        return {}
+
+    async def respond(self, method, params):
+        self.calls[method] += 1
+        delay = random.gauss(self.latency_ms, self.jitter_ms) if self.jitter_ms else self.latency_ms
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if method != 'getMe' and random.random() < self.retry_after_rate:
+            self.retry_afters += 1
+            return '429 Too Many Requests', {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }
+        return '200 OK', {'ok': True, 'result': self.result(method, params)}
+
+    def result(self, method, params):
+        if method == 'getMe':
+            return {**BOT_USER, 'can_join_groups': True, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': False}
+        if method.startswith('send') or method.startswith('edit'):
+            self._message_id += 1
+            chat_id = params.get('chat_id', 0)
+            message = {'message_id': params.get('message_id', self._message_id), 'date': int(time()),
+                       'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}, 'from': BOT_USER}
+            if 'text' in params:
+                message['text'] = params['text']
+            if 'caption' in params:
+                message['caption'] = params['caption']
+            return message
+        return True
+
+
+class DisposablePostgres:
+    """initdb у тимчасовий каталог і pg_ctl на вільному порту; каталог видаляється після тесту"""
+    def __init__(self):
+        self.bin_dir = self._find_bin_dir()
+        self.dir = None
+        self.url = None
+
+    @staticmethod
+    def _find_bin_dir():
+        candidates = [os.getenv('PG_BIN'), os.path.dirname(shutil.which('initdb') or '')]
+        candidates += sorted(glob.glob('/usr/lib/postgresql/*/bin'), reverse=True)
+        for path in candidates:
+            if path and os.path.exists(os.path.join(path, 'initdb')):
+                return path
+        raise SystemExit('❌ initdb не знайдено: додай Postgres у PATH, задай PG_BIN або передай --database-url')
+
+    def _run(self, tool, *args):
+        subprocess.run([os.path.join(self.bin_dir, tool), *args], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def __enter__(self):
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            raise SystemExit('❌ initdb не запускається від root: запусти від іншого користувача або передай --database-url')
+        self.dir = tempfile.mkdtemp(prefix='loadtest-pg-')
+        data = os.path.join(self.dir, 'data')
+        port = free_port()
+        self._run('initdb', '-D', data, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--locale=C', '--no-sync')
+        self._run('pg_ctl', '-D', data, '-l', os.path.join(self.dir, 'postgres.log'), '-w', 'start',
+                  '-o', f"-p {port} -k {self.dir} -c listen_addresses=''")
+        self.url = f'postgresql://postgres@/postgres?host={self.dir}&port={port}'
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._run('pg_ctl', '-D', os.path.join(self.dir, 'data'), '-m', 'fast', '-w', 'stop')
+        finally:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def chat_for(user_id, chats):
+    """Особистий чат користувача або одна з chats групових (там спрацьовує ліміт на чат)"""
+    return -1_000_000_000 - user_id % chats if chats else user_id
+
+
+class SyntheticUser:
+    """Будує оновлення одного користувача так, як їх прислав би Telegram"""
+    update_ids = iter(range(1, 1 << 62))
+
+    def __init__(self, user_id, chat_id):
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+        self.chat = {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}
+        self.message_id = 0
+
+    def _message(self, text, sender):
+        self.message_id += 1
+        return {'message_id': self.message_id, 'date': int(time()), 'chat': self.chat, 'from': sender, 'text': text}
+
+    def command(self, text):
+        message = self._message(text, self.user)
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def tap(self, data):
+        update_id = next(self.update_ids)
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': self.user, 'chat_instance': str(self.chat['id']),
+            'data': data, 'message': self._message('…', BOT_USER),
+        }}
+
+    def scenario(self, encode, checkin_id, checkout_id, workload):
+        """encode - bot.callback_data: кнопки кодуються так само, як у клавіатурах бота"""
+        yield 'start', self.command('/start')
+        yield 'checkin', self.tap(encode('checkin'))
+        yield 'ci', self.tap(encode('checkin_item', item_id=checkin_id))
+        yield 'workload', self.tap(encode('workload', workload=workload))
+        yield 'team', self.tap(encode('team'))
+        yield 'checkout', self.tap(encode('checkout'))
+        yield 'co', self.tap(encode('checkout_item', item_id=checkout_id))
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def histogram_counts(histogram):
+    """Кількість спостережень гістограми bot.py по першій мітці"""
+    with histogram._lock:
+        return Counter({key[0] if key else '': state[2] for key, state in histogram._values.items()})
+
+
+def seed_library(bot, items):
+    """Заповнити порожню бібліотеку: текст, фото, гіфки і відео по колу"""
+    bot.init_db()
+    if any(bot.get_shared_media_from_db(strict=True)[0].values()):
+        return
+    types = ('text', 'photo', 'animation', 'video')
+    for kind in ('checkin', 'checkout'):
+        for i in range(items):
+            media_type = types[i % len(types)]
+            content = f'{kind} {i}' if media_type == 'text' else f'loadtest-{media_type}-{i}'
+            bot.add_media_item_to_db(kind, {'type': media_type, 'content': content, 'name': f'{kind}{i}'})
+
+
+async def drive(bot, api, args):
+    """Прогнати всіх користувачів через Application і повернути зведення"""
+    from telegram import Update
+
+    app = bot.build_application(TOKEN, with_updater=False)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    startup_calls = sum(api.calls.values())
+    db_before = histogram_counts(bot.DB_QUERY_SECONDS)
+    errors_before = sum(value for _, value in bot.HANDLER_ERRORS.samples())
+
+    checkin_ids = [item['id'] for item in bot.shared_media['checkin']]
+    checkout_ids = [item['id'] for item in bot.shared_media['checkout']]
+    workloads = list(bot.WORKLOAD)
+    latencies = {step: [] for step in STEPS}
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def user_flow(index):
+        user_id = FIRST_USER_ID + index
+        user = SyntheticUser(user_id, chat_for(user_id, args.chats))
+        async with limit:
+            for step, data in user.scenario(bot.callback_data, random.choice(checkin_ids), random.choice(checkout_ids),
+                                            random.choice(workloads) if args.random_workload else '🟢'):
+                update = Update.de_json(data, app.bot)
+                started = monotonic()
+                await app.process_update(update)
+                latencies[step].append(monotonic() - started)
+                if args.think_ms:
+                    await asyncio.sleep(random.expovariate(1000 / args.think_ms))
+
+    started = monotonic()
+    await asyncio.gather(*(user_flow(i) for i in range(args.users)))
+    elapsed = monotonic() - started
+
+    # Дочікуємось фонових видалень і пакетного запису статусів, щоб їх теж порахувати
+    await bot.outbound.drain()
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+    updates = sum(len(v) for v in latencies.values())
+    db_calls = histogram_counts(bot.DB_QUERY_SECONDS) - db_before
+    telegram_calls = sum(api.calls.values()) - startup_calls
+    all_latencies = [value for values in latencies.values() for value in values]
+    handler_errors = sum(value for _, value in bot.HANDLER_ERRORS.samples()) - errors_before
+    return {
+        'updates': updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / elapsed, 1),
+        'p50_ms': round(percentile(all_latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(all_latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(all_latencies, 0.99) * 1000, 2),
+        'steps': {step: {'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+                         'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+                         'p99_ms': round(percentile(values, 0.99) * 1000, 2)} for step, values in latencies.items()},
+        'db_calls_per_update': round(sum(db_calls.values()) / updates, 3),
+        'db_calls': dict(db_calls.most_common()),
+        'telegram_calls_per_update': round(telegram_calls / updates, 3),
+        'telegram_calls': dict(api.calls.most_common()),
+        'retry_after_injected': api.retry_afters,
+        'handler_errors': handler_errors,
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+
+def load_previous(path, params):
+    """Останній збережений запуск з тими ж параметрами"""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['params'] == params:
+                previous = record
+    return previous
+
+
+def print_report(results, previous):
+    print(f"\n📊 Оновлень: {results['updates']} за {results['seconds']} с ({results['updates_per_second']} онов./с)")
+    print(f"{'крок':>10} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for step, stats in results['steps'].items():
+        print(f"{step:>10} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+    print(f"{'усього':>10} {results['p50_ms']:>9} {results['p95_ms']:>9} {results['p99_ms']:>9}")
+    print(f"🗄 DB-хелперів на оновлення: {results['db_calls_per_update']}  {results['db_calls']}")
+    print(f"📨 Викликів Telegram на оновлення: {results['telegram_calls_per_update']}  {results['telegram_calls']}")
+    print(f"⏳ Впорснуто RetryAfter: {results['retry_after_injected']}, помилок хендлерів: {results['handler_errors']}")
+    if previous:
+        print(f"\n↔️ Порівняння з {previous['commit']}{'+' if previous['dirty'] else ''} ({previous['at']}):")
+        for key in COMPARED:
+            before, after = previous['results'][key], results[key]
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"{key:>26}: {before:>10} → {after:<10} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100, help='користувачів, що проходять сценарій одночасно')
+    parser.add_argument('--chats', type=int, default=0, help='кількість групових чатів (0 - кожен у своєму особистому)')
+    parser.add_argument('--library', type=int, default=20, help='елементів check-in і check-out у бібліотеці')
+    parser.add_argument('--random-workload', action='store_true', help='випадкова завантаженість замість w_🟢')
+    parser.add_argument('--think-ms', type=float, default=0.0, help='середня пауза користувача між кроками, мс')
+    parser.add_argument('--api-ms', type=float, default=20.0, help='затримка фейкового Bot API, мс')
+    parser.add_argument('--api-jitter-ms', type=float, default=5.0)
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help='частка викликів, що отримують 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after у відповіді 429, с')
+    parser.add_argument('--global-rate', type=float, default=None,
+                        help='OUTBOUND_GLOBAL_RATE для тесту (за замовчуванням - як у боті)')
+    parser.add_argument('--chat-rate', type=float, default=None,
+                        help='OUTBOUND_CHAT_RATE для тесту (за замовчуванням - як у боті)')
+    parser.add_argument('--database-url', help='порожня одноразова БД замість initdb')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--results', default=RESULTS_PATH)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    params = {key: getattr(args, key) for key in (
+        'users', 'concurrency', 'chats', 'library', 'random_workload', 'think_ms', 'api_ms', 'api_jitter_ms',
+        'retry_after_rate', 'retry_after', 'global_rate', 'chat_rate', 'seed')}
+
+    async def run(database_url):
+        api = FakeBotAPI(args.api_ms, args.api_jitter_ms, args.retry_after_rate, args.retry_after)
+        await api.start()
+        # bot.py читає конфіг при імпорті
+        # Свій журнал записів на прогін: пачки з попередніх прогонів не потрапляють в нову БД
+        journal = os.path.join(tempfile.mkdtemp(prefix='loadtest-journal-'), 'journal.sqlite3')
+        os.environ.update({'DATABASE_URL': database_url, 'BOT_API_URL': api.url, 'PORT': '0', 'JOURNAL_PATH': journal})
+        os.environ.pop('WEBHOOK_URL', None)
+        if args.global_rate:
+            os.environ['OUTBOUND_GLOBAL_RATE'] = str(args.global_rate)
+        if args.chat_rate:
+            os.environ['OUTBOUND_CHAT_RATE'] = str(args.chat_rate)
+        import bot
+        seed_library(bot, args.library)
+        bot.warm_up()
+        try:
+            return await drive(bot, api, args)
+        finally:
+            await api.stop()
+
+    print(f"🚀 Користувачів: {args.users}, одночасно: {args.concurrency}, Bot API: {args.api_ms}±{args.api_jitter_ms} мс, "
+          f"429: {args.retry_after_rate:.2%}")
+    if args.database_url:
+        results = asyncio.run(run(args.database_url))
+    else:
+        with DisposablePostgres() as pg:
+            results = asyncio.run(run(pg.url))
+
+    previous = load_previous(args.results, params)
+    print_report(results, previous)
+    if not args.no_save:
+        commit, dirty = git_revision()
+        os.makedirs(os.path.dirname(args.results), exist_ok=True)
+        with open(args.results, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'commit': commit, 'dirty': dirty, 'at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                                'params': params, 'results': results}, ensure_ascii=False) + '\n')
+        print(f"💾 Збережено в {args.results}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""Бенчмарк шардованого режиму: як пропускна здатність росте з кількістю воркерів.
+
+Запускає справжні воркери bot.shard_worker_main (Application, хендлери, Postgres, черга вихідних
+викликів) за тим самим ShardDispatcher, що й bot.py у режимі BOT_WORKERS > 1. Bot API - фейковий
+сервер з benchmarks/loadtest.py, кнопки кодуються bot.callback_data. Кожен воркер перевіряє, що
+оновлення кожного користувача оброблялись по порядку.
+
+Час - від першого оновлення до завершення всіх воркерів (включно з дописуванням черг при зупинці).
+Ліміти Telegram за замовчуванням зняті, щоб міряти обробку, а не OUTBOUND_GLOBAL_RATE.
+
+    python benchmarks/sharding.py --workers 1 2 4 --users 500 --api-ms 5
+
+Postgres - як у loadtest.py: initdb/pg_ctl у тимчасовому каталозі або --database-url.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import TOKEN, DisposablePostgres, FakeBotAPI, SyntheticUser, chat_for, histogram_counts, seed_library  # noqa: E402
+
+FIRST_USER_ID = 20_000_000
+
+
+def bench_worker(index, count, queue, ready, results):
+    """Воркер бенчмарку: bot.shard_worker_main з обробником, що перевіряє порядок оновлень"""
+    import bot
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    last_seen = {}
+    state = {'in_order': True}
+    build = bot.build_application
+
+    def build_application(*args, **kwargs):
+        app = build(*args, **kwargs)
+
+        async def check_order(update, context):
+            user_id = update.effective_user.id
+            if update.update_id <= last_seen.get(user_id, -1):
+                state['in_order'] = False
+            last_seen[user_id] = update.update_id
+
+        app.add_handler(TypeHandler(Update, check_order), group=-2)
+        return app
+
+    bot.build_application = build_application
+    bot.shard_worker_main(index, count, queue, ready, TOKEN)
+    processed = sum(histogram_counts(bot.UPDATE_SECONDS).values())
+    errors = sum(value for _, value in bot.HANDLER_ERRORS.samples())
+    results.put((index, processed, state['in_order'], errors))
+
+
+def make_updates(bot, users, checkin_ids, checkout_ids, chats):
+    """Сценарії користувачів упереміш: крок 1 усіх, крок 2 усіх, ... (порядок кожного зберігається)"""
+    flows = []
+    for i in range(users):
+        user_id = FIRST_USER_ID + i
+        user = SyntheticUser(user_id, chat_for(user_id, chats))
+        flows.append(user.scenario(bot.callback_data, checkin_ids[i % len(checkin_ids)],
+                                   checkout_ids[i % len(checkout_ids)], '🟢'))
+    updates = []
+    for steps in zip(*flows):
+        updates += [data for _, data in steps]
+    return updates
+
+
+def run(bot, workers, updates):
+    ctx = bot.multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    dispatcher = bot.ShardDispatcher(workers, bench_worker, (results,))
+    dispatcher.start()
+    while not dispatcher.all_ready():
+        sleep(0.05)
+    started = monotonic()
+    for data in updates:
+        dispatcher.dispatch(data)
+    for queue in dispatcher.queues:
+        queue.put(None)
+    stats = [results.get() for _ in range(workers)]
+    elapsed = monotonic() - started
+    for process in dispatcher.processes:
+        process.join()
+    processed = sum(s[1] for s in stats)
+    return {
+        'workers': workers,
+        'processed': processed,
+        'seconds': elapsed,
+        'updates_per_second': processed / elapsed,
+        'in_order': all(s[2] for s in stats),
+        'handler_errors': sum(s[3] for s in stats),
+        'per_worker': sorted((s[0], s[1]) for s in stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--chats', type=int, default=0, help='кількість групових чатів (0 - кожен у своєму особистому)')
+    parser.add_argument('--library', type=int, default=20, help='елементів check-in і check-out у бібліотеці')
+    parser.add_argument('--api-ms', type=float, default=5.0, help='затримка фейкового Bot API, мс')
+    parser.add_argument('--api-jitter-ms', type=float, default=1.0)
+    parser.add_argument('--global-rate', type=float, default=1e6, help='OUTBOUND_GLOBAL_RATE для воркерів')
+    parser.add_argument('--chat-rate', type=float, default=1e6, help='OUTBOUND_CHAT_RATE для воркерів')
+    parser.add_argument('--database-url', help='порожня одноразова БД замість initdb')
+    args = parser.parse_args()
+
+    async def bench(database_url):
+        api = FakeBotAPI(args.api_ms, args.api_jitter_ms, 0.0, 1)
+        await api.start()
+        # Воркери (spawn) успадковують оточення: bot.py читає конфіг при імпорті
+        journal = os.path.join(tempfile.mkdtemp(prefix='sharding-journal-'), 'journal.sqlite3')
+        os.environ.update({'DATABASE_URL': database_url, 'BOT_API_URL': api.url, 'PORT': '0', 'JOURNAL_PATH': journal,
+                           'OUTBOUND_GLOBAL_RATE': str(args.global_rate), 'OUTBOUND_CHAT_RATE': str(args.chat_rate)})
+        os.environ.pop('WEBHOOK_URL', None)
+        import bot
+        seed_library(bot, args.library)
+        media, _ = bot.get_shared_media_from_db(strict=True)
+        updates = make_updates(bot, args.users, [item['id'] for item in media['checkin']],
+                               [item['id'] for item in media['checkout']], args.chats)
+
+        print(f"CPU: {os.cpu_count()}, оновлень: {len(updates)}, користувачів: {args.users}, Bot API: {args.api_ms} мс")
+        print(f"{'воркерів':>8} {'онов./с':>10} {'прискорення':>12} {'порядок':>8} {'помилок':>8}  розподіл")
+        baseline = None
+        loop = asyncio.get_running_loop()
+        try:
+            for workers in args.workers:
+                # Диспетчер блокує: у потоці, щоб фейковий Bot API в цьому loop відповідав воркерам
+                result = await loop.run_in_executor(None, run, bot, workers, updates)
+                baseline = baseline or result['updates_per_second']
+                print(f"{workers:>8} {result['updates_per_second']:>10.0f} {result['updates_per_second'] / baseline:>11.2f}x "
+                      f"{'OK' if result['in_order'] else 'ПОРУШЕНО':>8} {result['handler_errors']:>8}  "
+                      f"{[n for _, n in result['per_worker']]}")
+        finally:
+            await api.stop()
+
+    if args.database_url:
+        asyncio.run(bench(args.database_url))
+    else:
+        with DisposablePostgres() as pg:
+            asyncio.run(bench(pg.url))
+
+
+if __name__ == '__main__':
+    main()
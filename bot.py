@@ -1,603 +1,3473 @@
 import os
 import json
+import threading
+import functools
+import hmac
+import secrets
+import signal
+import multiprocessing
+import contextvars
+import sqlite3
 import psycopg2
-from psycopg2.extras import Json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, ConversationHandler
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic, time_ns
 from threading import Thread
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from datetime import datetime, time
+from telegram import (Bot, BotCommand, Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle,
+                      InlineQueryResultCachedMpeg4Gif, InlineQueryResultCachedPhoto, InlineQueryResultCachedVideo,
+                      InputTextMessageContent)
+from telegram.constants import ChatMemberStatus, ChatType
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, PersistenceInput, CommandHandler, CallbackQueryHandler, ContextTypes, InlineQueryHandler, MessageHandler, filters, ConversationHandler
+from datetime import datetime, time, date, timedelta, timezone
+from zoneinfo import ZoneInfo
 import asyncio
+import heapq
+import random
 
 ADDING_CHECKIN_MEDIA, ADDING_CHECKOUT_MEDIA, NAMING_CHECKIN_MEDIA, NAMING_CHECKOUT_MEDIA = range(4)
 
-# Database connection
-def get_db_connection():
-    """Підключення до бази даних"""
+# Метрики у форматі Prometheus (без зовнішніх залежностей), віддаються на /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = []
+
+class Metric:
+    """Базова метрика з мітками; значення пишуться і з event loop, і з потоків БД"""
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+    def _labels(self, key, extra=()):
+        pairs = [*zip(self.label_names, key), *extra]
+        if not pairs:
+            return ''
+        escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def samples(self):
+        with self._lock:
+            return [(f'{self.name}{self._labels(key)}', value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{sample} {value:g}' for sample, value in self.samples()]
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Gauge; func (якщо задано) рахує значення в момент збору: число або {кортеж міток: число}"""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        super().__init__(name, help_text, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.func is None:
+            return super().samples()
+        value = self.func()
+        values = value if isinstance(value, dict) else {(): value}
+        return [(f'{self.name}{self._labels(key)}', v) for key, v in values.items()]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - started, **labels)
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, c in zip(self.buckets, counts):
+                    out.append((f'{self.name}_bucket{self._labels(key, [("le", f"{bound:g}")])}', c))
+                out.append((f'{self.name}_bucket{self._labels(key, [("le", "+Inf")])}', count))
+                out.append((f'{self.name}_sum{self._labels(key)}', total))
+                out.append((f'{self.name}_count{self._labels(key)}', count))
+        return out
+
+def render_metrics():
+    return '\n'.join(m.render() for m in METRICS) + '\n'
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Час обробки по хендлерах', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Винятки в хендлерах', ['handler'])
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Час DB-хелперів (включно з очікуванням з\'єднання)', ['helper'])
+TELEGRAM_SECONDS = Histogram('bot_telegram_api_seconds', 'Час викликів Telegram Bot API', ['method'])
+TELEGRAM_ERRORS = Counter('bot_telegram_api_errors_total', 'Помилки Telegram Bot API', ['method', 'code'])
+
+def timed_handler(func):
+    """Латентність і помилки хендлера в bot_handler_seconds / bot_handler_errors_total"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = monotonic()
+        try:
+            with trace_span(func.__name__, 'handler'):
+                return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=func.__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(monotonic() - started, handler=func.__name__)
+    return wrapper
+
+def timed_db(func):
+    """Кількість і час викликів DB-хелпера в bot_db_query_seconds"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with DB_QUERY_SECONDS.time(helper=func.__name__), trace_span(func.__name__, 'db'):
+            return func(*args, **kwargs)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, що міряє кожен виклик Bot API за назвою методу"""
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = monotonic()
+        try:
+            with trace_span(api_method, 'api') as span:
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+                if span:
+                    span.attrs['code'] = code
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=api_method, code=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(monotonic() - started, method=api_method)
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(method=api_method, code=code)
+        return code, payload
+
+# Трасування оновлень: дерево спанів (хендлер, DB-хелпер, SQL, виклик Bot API) в contextvar
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', 1000))  # повільніші оновлення логуються з деревом спанів; 0 - вимкнути
+TRACE_EXPORT_FILE = os.getenv('TRACE_EXPORT_FILE')  # усі трейси у форматі Chrome Trace Event (Perfetto, chrome://tracing)
+
+UPDATE_SECONDS = Histogram('bot_update_seconds', 'Повний час обробки оновлення')
+UPDATE_ROUND_TRIPS = Histogram('bot_update_round_trips', 'Звернень на оновлення: sql - запити в БД, api - виклики Bot API',
+                               ['kind'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+trace_exporter = None
+
+class Span:
+    __slots__ = ('name', 'kind', 'attrs', 'start', 'duration', 'children', 'trace')
+
+    def __init__(self, name, kind, trace, attrs=None, start=None):
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs or {}
+        self.start = monotonic() if start is None else start
+        self.duration = None
+        self.children = []
+        self.trace = trace
+
+    def end(self):
+        self.duration = monotonic() - self.start
+        return self.duration
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_dict(self):
+        node = {'name': self.name, 'kind': self.kind, 'ms': round((self.duration or 0) * 1000, 2)}
+        if self.attrs:
+            node['attrs'] = self.attrs
+        if self.children:
+            node['children'] = [child.to_dict() for child in self.children]
+        return node
+
+class Trace:
+    """Трейс одного оновлення; спани дописуються з event loop і з потоків БД"""
+    def __init__(self, update):
+        self.update_id = update.update_id
+        self.user_id = update.effective_user.id if update.effective_user else None
+        self.route = update_route(update)
+        self.wall_us = time_ns() // 1000
+        self.root = Span('update', 'update', self, {'update_id': self.update_id, 'route': self.route})
+        self.finished = False
+
+    def counts(self):
+        counts = {'handler': 0, 'db': 0, 'sql': 0, 'api': 0}
+        for span in self.root.walk():
+            if span.kind in counts:
+                counts[span.kind] += 1
+        return counts
+
+def update_route(update):
+    """Коротка назва оновлення для логів: callback_data або команда"""
+    if update.callback_query:
+        return update.callback_query.data
+    if update.message and update.message.text and update.message.text.startswith('/'):
+        return update.message.text.split()[0]
+    if update.inline_query:
+        return 'inline'
+    return 'message'
+
+@contextmanager
+def trace_span(name, kind, **attrs):
+    """Дочірній спан поточного; поза оновленням (фонові задачі) нічого не записує"""
+    parent = _current_span.get()
+    if parent is None or parent.trace.finished:
+        yield None
+        return
+    span = Span(name, kind, parent.trace, attrs)
+    parent.children.append(span)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        span.end()
+        _current_span.reset(token)
+
+def record_span(name, kind, started, **attrs):
+    """Додати вже завершений спан, що почався в started (monotonic)"""
+    parent = _current_span.get()
+    if parent is not None and not parent.trace.finished:
+        span = Span(name, kind, parent.trace, attrs, started)
+        span.end()
+        parent.children.append(span)
+
+def finish_trace(trace):
+    duration = trace.root.end()
+    trace.finished = True
+    counts = trace.counts()
+    UPDATE_SECONDS.observe(duration)
+    UPDATE_ROUND_TRIPS.observe(counts['sql'], kind='sql')
+    UPDATE_ROUND_TRIPS.observe(counts['api'], kind='api')
+    if TRACE_SLOW_MS > 0 and duration * 1000 >= TRACE_SLOW_MS:
+        record = {'update_id': trace.update_id, 'user_id': trace.user_id, 'route': trace.route,
+                  'ms': round(duration * 1000, 1), 'round_trips': counts, 'spans': trace.root.to_dict()}
+        print(f"🐢 Повільне оновлення: {json.dumps(record, ensure_ascii=False)}")
+    if trace_exporter:
+        trace_exporter.write(trace)
+
+class ChromeTraceExporter:
+    """Запис трейсів у форматі Chrome Trace Event.
+
+    Файл - JSON-масив без закриваючої дужки (формат це дозволяє), тому трейси просто дописуються.
+    Кожне оновлення - окремий трек (tid = update_id), процес воркера - окремий pid.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+        if self.file.tell() == 0:
+            self.file.write('[\n')
+
+    def write(self, trace):
+        anchor = trace.root.start
+        for span in trace.root.walk():
+            event = {'name': span.name, 'cat': span.kind, 'ph': 'X', 'pid': os.getpid(), 'tid': trace.update_id,
+                     'ts': trace.wall_us + int((span.start - anchor) * 1_000_000),
+                     'dur': int((span.duration or 0) * 1_000_000)}
+            if span.attrs:
+                event['args'] = span.attrs
+            self.file.write(json.dumps(event, ensure_ascii=False, default=str) + ',\n')
+
+    def close(self):
+        self.file.close()
+
+class TracedApplication(Application):
+    """Application, що відкриває трейс на кожне оновлення (усі хендлери, стани діалогів, кнопки)"""
+    async def process_update(self, update):
+        if TRACE_SLOW_MS <= 0 and trace_exporter is None:
+            return await super().process_update(update)
+        trace = Trace(update)
+        token = _current_span.set(trace.root)
+        try:
+            return await super().process_update(update)
+        finally:
+            _current_span.reset(token)
+            finish_trace(trace)
+
+class TracedCursor(psycopg2.extensions.cursor):
+    """Курсор, що записує кожен запит як sql-спан (один запит - одне звернення до БД)"""
+    def execute(self, query, vars=None):
+        if _current_span.get() is None:
+            return super().execute(query, vars)
+        with trace_span('sql', 'sql', statement=sql_label(query)):
+            return super().execute(query, vars)
+
+def sql_label(query):
+    """Початок запиту без значень: для трейсів, без даних користувачів"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = ' '.join(query.split())
+    return query.split(' VALUES ', 1)[0].split(' WHERE ', 1)[0][:80]
+
+# Налаштування пулу з'єднань
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 5))
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', 5))  # секунди на TCP+auth
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', 5))  # очікування вільного з'єднання
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 5000))
+DB_HEALTHCHECK_IDLE = float(os.getenv('DB_HEALTHCHECK_IDLE', 30))  # перевіряти з'єднання, що простоювали довше
+
+DB_BREAKER_THRESHOLD = int(os.getenv('DB_BREAKER_THRESHOLD', 3))  # невдалих з'єднань поспіль до розмикання
+DB_BREAKER_COOLDOWN = float(os.getenv('DB_BREAKER_COOLDOWN', 5))  # секунди між пробними з'єднаннями
+
+class PoolTimeout(Exception):
+    """Немає вільного з'єднання в пулі за DB_ACQUIRE_TIMEOUT"""
+
+class DBUnavailable(Exception):
+    """Circuit breaker розімкнений: БД недоступна, запит не надсилається"""
+
+class CircuitBreaker:
+    """Після threshold невдач поспіль пропускає одну пробну спробу раз на cooldown секунд"""
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def ready(self):
+        """Чи пропустить allow() спробу зараз (без витрачання пробної)"""
+        return not self.is_open or monotonic() >= self.retry_at
+
+    def allow(self):
+        with self._lock:
+            if not self.is_open:
+                return True
+            now = monotonic()
+            if now < self.retry_at:
+                return False
+            self.retry_at = now + self.cooldown
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.is_open:
+                print("🔌 БД знову доступна")
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures == self.threshold:
+                print(f"🔌 БД недоступна: {self.failures} невдач поспіль, пробна спроба раз на {self.cooldown:g} с")
+            self.retry_at = monotonic() + self.cooldown
+
+class DBPool:
+    """Обмежений пул з'єднань psycopg2 з перевіркою здоров'я та таймаутами"""
+    def __init__(self, dsn, minconn, maxconn, breaker):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        # Мертва БД: запити падають одразу, а не чекають connect_timeout кожен
+        self.breaker = breaker
+        self._pool = None
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool кидає PoolError при вичерпанні, тому чергу очікування даємо семафором
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+
+    def _ensure_pool(self):
+        # Пул створюється ліниво, щоб недоступна при старті БД не валила бота
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(
+                        self.minconn, self.maxconn, self.dsn,
+                        connect_timeout=DB_CONNECT_TIMEOUT,
+                        options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}',
+                        keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+                        cursor_factory=TracedCursor,
+                    )
+        return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if monotonic() - self._last_used.get(id(conn), 0) < DB_HEALTHCHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        pool = self._ensure_pool()
+        conn = pool.getconn()
+        if not self._is_healthy(conn):
+            # Мертве з'єднання закриваємо і беремо нове
+            self._last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Видати з'єднання з пулу; commit при успіху, rollback при помилці"""
+        if not self.breaker.allow():
+            raise DBUnavailable('circuit breaker розімкнений')
+        started = monotonic()
+        if not self._slots.acquire(timeout=DB_ACQUIRE_TIMEOUT):
+            record_span('pool.acquire', 'pool', started, error='PoolTimeout')
+            raise PoolTimeout(f'немає вільного з\'єднання за {DB_ACQUIRE_TIMEOUT} с')
+        conn = None
+        broken = False
+        try:
+            try:
+                conn = self._checkout()
+            except psycopg2.Error:
+                self.breaker.failure()
+                raise
+            # Очікування слота + перевірка здоров'я/нове з'єднання
+            record_span('pool.acquire', 'pool', started)
+            try:
+                yield conn
+                conn.commit()
+                self.breaker.success()
+            except Exception as e:
+                broken = conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+                if broken and not isinstance(e, psycopg2.extensions.QueryCanceledError):
+                    self.breaker.failure()
+                if not conn.closed:
+                    conn.rollback()
+                raise
+        finally:
+            if conn is not None:
+                if broken or conn.closed:
+                    self._last_used.pop(id(conn), None)
+                else:
+                    self._last_used[id(conn)] = monotonic()
+                self._pool.putconn(conn, close=broken or bool(conn.closed))
+            self._slots.release()
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def ping(self):
+        """Перевірити, що БД відповідає"""
+        try:
+            with self.cursor() as cur:
+                cur.execute('SELECT 1')
+            return True
+        except Exception as e:
+            print(f"❌ БД недоступна: {e}")
+            return False
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            self._last_used.clear()
+
+db_pool = DBPool(os.getenv('DATABASE_URL'), DB_POOL_MIN, DB_POOL_MAX, CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_COOLDOWN))
+# Один потік на з'єднання: блокуючі запити йдуть сюди, а не в event loop
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix='db')
+
+async def run_db(func, *args, **kwargs):
+    """Виконати синхронний DB-хелпер у пулі потоків, не блокуючи event loop"""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if _current_span.get() is not None:
+        # run_in_executor не переносить contextvars: без цього спани БД загубились би
+        call = functools.partial(contextvars.copy_context().run, call)
+    return await loop.run_in_executor(db_executor, call)
+
+# Версія схеми: збільшувати при кожній зміні DDL у create_schema
+SCHEMA_VERSION = 6
+SCHEMA_LOCK_ID = 0x636b696e  # pg_advisory_xact_lock: міграцію робить один процес
+# Зміни бібліотеки по одній: версії комітяться в порядку зростання, і читач не пропустить меншу
+LIBRARY_LOCK_ID = 0x6d656469
+LIBRARY_CHANNEL = 'media_library'  # NOTIFY після кожної зміни media_items
+# Поточна версія бібліотеки: найбільша серед живих і видалених елементів
+LIBRARY_VERSION_SQL = 'SELECT GREATEST((SELECT MAX(version) FROM media_items), (SELECT MAX(version) FROM media_deleted), 0)'
+
+def schema_is_current(cur):
+    cur.execute("SELECT to_regclass('schema_version')")
+    if cur.fetchone()[0] is None:
+        return False
+    cur.execute('SELECT version FROM schema_version')
+    row = cur.fetchone()
+    return row is not None and row[0] >= SCHEMA_VERSION
+
+@timed_db
+def init_db():
+    """Ініціалізація таблиць бази даних; якщо схема актуальна - DDL пропускається"""
+    try:
+        with db_pool.cursor() as cur:
+            if not schema_is_current(cur):
+                # Воркери стартують одночасно: решта чекає на lock і бачить уже готову схему
+                cur.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_ID,))
+                if not schema_is_current(cur):
+                    create_schema(cur)
+                    print(f"✅ База даних ініціалізована (схема v{SCHEMA_VERSION})")
+                    return True
+            # Партиції журналу на нові місяці потрібні і при актуальній схемі
+            ensure_event_partitions(cur)
+        return True
+    except Exception as e:
+        print(f"❌ Помилка ініціалізації БД: {e}")
+        return False
+
+def create_schema(cur):
+    """Усі таблиці й індекси (ідемпотентно) і запис версії схеми"""
+    # СПІЛЬНА бібліотека медіа: один рядок на елемент, kind = checkin/checkout
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS media_items (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL CHECK (kind IN ('checkin', 'checkout')),
+            position BIGINT NOT NULL,
+            media_type TEXT NOT NULL,
+            content TEXT NOT NULL,
+            name TEXT NOT NULL DEFAULT '',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS media_items_kind_position ON media_items (kind, position, id)')
+    # Версія бібліотеки: кожна зміна рядка (і ручна теж) отримує наступний номер послідовності,
+    # видалений елемент лишає запис у media_deleted - процеси підтягують тільки змінене
+    cur.execute('CREATE SEQUENCE IF NOT EXISTS media_library_version')
+    cur.execute('ALTER TABLE media_items ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0')
+    cur.execute('CREATE INDEX IF NOT EXISTS media_items_version ON media_items (version)')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS media_deleted (
+            item_id BIGINT PRIMARY KEY,
+            version BIGINT NOT NULL
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS media_deleted_version ON media_deleted (version)')
+    cur.execute(f'''
+        CREATE OR REPLACE FUNCTION media_items_versioned() RETURNS trigger AS $$
+        DECLARE
+            v BIGINT;
+        BEGIN
+            PERFORM pg_advisory_xact_lock({LIBRARY_LOCK_ID});
+            v := nextval('media_library_version');
+            PERFORM pg_notify('{LIBRARY_CHANNEL}', v::text);
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO media_deleted (item_id, version) VALUES (OLD.id, v)
+                ON CONFLICT (item_id) DO UPDATE SET version = EXCLUDED.version;
+                RETURN OLD;
+            END IF;
+            NEW.version := v;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    cur.execute('DROP TRIGGER IF EXISTS media_items_versioned ON media_items')
+    cur.execute('''
+        CREATE TRIGGER media_items_versioned BEFORE INSERT OR UPDATE OR DELETE ON media_items
+        FOR EACH ROW EXECUTE FUNCTION media_items_versioned()
+    ''')
+    migrate_shared_media(cur)
+    
+    # Таблиця для статусів користувачів
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS user_status (
+            user_id BIGINT PRIMARY KEY,
+            active BOOLEAN DEFAULT FALSE,
+            username TEXT,
+            workload TEXT
+        )
+    ''')
+    # Чат, де користувач відмічався останнім: за ним визначається розклад скидання
+    cur.execute('ALTER TABLE user_status ADD COLUMN IF NOT EXISTS chat_id BIGINT')
+    # Скидання торкається тільки активних: частковий індекс тримає їх окремо
+    cur.execute('CREATE INDEX IF NOT EXISTS user_status_active_chat ON user_status (chat_id) WHERE active')
+    # Час останнього check-in (з журналу відміток): за ним нагадування і автоматичний check-out
+    # вибирають користувачів діапазоном по індексу, а не перебором user_status
+    cur.execute('ALTER TABLE user_status ADD COLUMN IF NOT EXISTS checked_in_at TIMESTAMPTZ')
+    cur.execute('CREATE INDEX IF NOT EXISTS user_status_checked_in ON user_status (checked_in_at, user_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS user_status_active_since ON user_status (checked_in_at, user_id) WHERE active')
+    # Розклад скидання статусів; chat_id = 0 - розклад за замовчуванням
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reset_schedule (
+            chat_id BIGINT PRIMARY KEY,
+            reset_time TIME NOT NULL,
+            timezone TEXT NOT NULL,
+            last_reset_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    
+    # Журнал відміток (тільки додавання), партиції по місяцях
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_events (
+            id BIGSERIAL,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            kind TEXT NOT NULL CHECK (kind IN ('checkin', 'checkout', 'reset')),
+            workload TEXT,
+            occurred_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (id, occurred_at)
+        ) PARTITION BY RANGE (occurred_at)
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS attendance_events_user_time ON attendance_events (user_id, occurred_at DESC)')
+    cur.execute('CREATE INDEX IF NOT EXISTS attendance_events_time_brin ON attendance_events USING BRIN (occurred_at)')
+    ensure_event_partitions(cur)
+    # Денний підсумок відпрацьованого часу: /report читає тільки його
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_daily (
+            user_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            worked_seconds BIGINT NOT NULL DEFAULT 0,
+            sessions INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS attendance_daily_day ON attendance_daily (day)')
+    # checked_in_at для статусів, записаних до появи колонки
+    cur.execute('''
+        UPDATE user_status u SET checked_in_at = e.occurred_at
+        FROM (SELECT user_id, MAX(occurred_at) AS occurred_at FROM attendance_events
+              WHERE kind = 'checkin' GROUP BY user_id) e
+        WHERE u.user_id = e.user_id AND u.checked_in_at IS NULL
+    ''')
+    
+    # Стан діалогів і user_data (PostgresPersistence): рядки є тільки в незавершених
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state INT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (name, key)
+        )
+    ''')
+    # Останній перенесений у Postgres seq локального журналу записів (по одному на процес)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS journal_applied (
+            source TEXT PRIMARY KEY,
+            seq BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    # Надіслані нагадування: останній момент (due) кожного виду на користувача;
+    # спершу фіксується тут, тож інший процес чи перезапуск не надішле вдруге
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reminder_log (
+            user_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            due TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (user_id, kind)
+        )
+    ''')
+    # Закріплений живий список команди: повідомлення (по частинах) у кожному чаті
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS live_roster (
+            chat_id BIGINT PRIMARY KEY,
+            message_ids BIGINT[] NOT NULL
+        )
+    ''')
+    # Порожній message_ids - список саме створюється; claimed_at дає змогу перехопити покинуте створення
+    cur.execute('ALTER TABLE live_roster ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ NOT NULL DEFAULT now()')
+
+    # Версія схеми (один рядок): наступні старти з тією ж версією пропускають DDL
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version INT NOT NULL
+        )
+    ''')
+    cur.execute('''
+        INSERT INTO schema_version (version) VALUES (%s)
+        ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version
+    ''', (SCHEMA_VERSION,))
+
+EVENT_PARTITIONS_AHEAD = 2  # скільки наступних місяців створювати наперед
+
+def ensure_event_partitions(cur, today=None):
+    """Створити партиції attendance_events на поточний і наступні місяці (+ DEFAULT на всяк випадок)"""
+    today = today or datetime.now(timezone.utc).date()
+    month = date(today.year, today.month, 1)
+    for _ in range(EVENT_PARTITIONS_AHEAD + 1):
+        next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS attendance_events_{month:%Y%m} PARTITION OF attendance_events
+            FOR VALUES FROM ('{month} 00:00+00') TO ('{next_month} 00:00+00')
+        ''')
+        month = next_month
+    cur.execute('CREATE TABLE IF NOT EXISTS attendance_events_default PARTITION OF attendance_events DEFAULT')
+
+@timed_db
+def ensure_event_partitions_in_db():
+    with db_pool.cursor() as cur:
+        ensure_event_partitions(cur)
+
+def migrate_shared_media(cur):
+    """Перенести стару JSONB-бібліотеку (shared_media) у media_items"""
+    cur.execute("SELECT to_regclass('shared_media')")
+    if cur.fetchone()[0] is None:
+        return
+    # Блокуємо рядок, щоб два процеси не перенесли дані двічі
+    cur.execute("SELECT checkin_media, checkout_media FROM shared_media WHERE media_type = 'shared' FOR UPDATE")
+    row = cur.fetchone()
+    if not row or (not row[0] and not row[1]):
+        return
+    for kind, column in (('checkin', 'checkin_media'), ('checkout', 'checkout_media')):
+        cur.execute(f'''
+            INSERT INTO media_items (kind, position, media_type, content, name)
+            SELECT %s,
+                   COALESCE((SELECT MAX(position) FROM media_items WHERE kind = %s), 0) + e.ord,
+                   e.item->>'type', e.item->>'content', COALESCE(e.item->>'name', '')
+            FROM shared_media s, jsonb_array_elements(s.{column}) WITH ORDINALITY AS e(item, ord)
+            WHERE s.media_type = 'shared'
+        ''', (kind, kind))
+    # Очищаємо JSONB, щоб перенесення не повторилось при наступному старті
+    cur.execute("UPDATE shared_media SET checkin_media = '[]', checkout_media = '[]' WHERE media_type = 'shared'")
+    print(f"📦 Бібліотеку перенесено в media_items: Check-in={len(row[0] or [])}, Check-out={len(row[1] or [])}")
+
+# HTTP: webhook Telegram і health/readiness на одному asyncio-сервері
+HTTP_PORT = int(os.getenv('PORT', 10000))
+HTTP_KEEPALIVE = 75  # секунди простою keep-alive з'єднання
+HTTP_MAX_BODY = 1 << 20
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # якщо задано - webhook, інакше polling
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Telegram дозволяє 1-256 символів A-Z a-z 0-9 _ -
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+# Адреса Bot API: локальний telegram-bot-api або фейковий сервер з benchmarks/loadtest.py
+BOT_API_URL = os.getenv('BOT_API_URL', 'https://api.telegram.org').rstrip('/')
+
+# Кілька процесів: приймач оновлень роздає їх BOT_WORKERS воркерам за id користувача
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+PROCESS_ROLE = 'single'  # single | ingest | worker
+WORKER_INDEX = 0
+WORKER_COUNT = 1
+
+def owns_user(user_id):
+    """Чи цей процес відповідає за користувача (у звичайному режимі - за всіх)"""
+    return user_id % WORKER_COUNT == WORKER_INDEX
+
+# Готовність: пул БД відповів і кеші (бібліотека, статуси) завантажені
+readiness = {'db': False, 'caches': False}
+
+def is_ready():
+    return all(readiness.values())
+
+# Тривалість фаз старту (секунди): лог, /readyz і bot_startup_phase_seconds
+STARTED_AT = monotonic()
+startup_phases = {}
+
+Gauge('bot_startup_phase_seconds', 'Тривалість фаз старту', ['phase'], func=lambda: {(k,): v for k, v in startup_phases.items()})
+
+@contextmanager
+def startup_phase(name):
+    started = monotonic()
+    try:
+        yield
+    finally:
+        startup_phases[name] = monotonic() - started
+        print(f"⏱ Старт, {name}: {startup_phases[name] * 1000:.0f} мс")
+
+def http_root(request):
+    return '200 OK', 'text/html', b'Bot running!'
+
+def http_healthz(request):
+    return '200 OK', 'text/plain', b'ok'
+
+def http_metrics(request):
+    return '200 OK', 'text/plain; version=0.0.4; charset=utf-8', render_metrics().encode()
+
+def http_readyz(request):
+    startup_ms = {phase: round(seconds * 1000, 1) for phase, seconds in startup_phases.items()}
+    body = json.dumps({**readiness, 'startup_ms': startup_ms}).encode()
+    return ('200 OK' if is_ready() else '503 Service Unavailable'), 'application/json', body
+
+# path -> обробник GET-запиту; обробник повертає (статус, content-type, тіло)
+HTTP_GET_ROUTES = {
+    '/': http_root,
+    '/healthz': http_healthz,
+    '/readyz': http_readyz,
+    '/metrics': http_metrics,
+}
+
+# У режимі кількох процесів сирі оновлення йдуть не в Application, а в ShardDispatcher
+webhook_sink = None
+
+async def http_webhook(app, request):
+    """Прийняти оновлення від Telegram і покласти в чергу PTB"""
+    token = request['headers'].get('x-telegram-bot-api-secret-token', '')
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return '403 Forbidden', 'text/plain', b'forbidden'
+    try:
+        data = json.loads(request['body'])
+        update = None if webhook_sink else Update.de_json(data, app.bot)
+    except Exception as e:
+        print(f"❌ Некоректне оновлення webhook: {e}")
+        return '400 Bad Request', 'text/plain', b'bad request'
+    if webhook_sink:
+        webhook_sink(data)
+    else:
+        await app.update_queue.put(update)
+    return '200 OK', 'text/plain', b'ok'
+
+async def route_http(app, request):
+    if request['method'] == 'GET' and request['path'] in HTTP_GET_ROUTES:
+        return HTTP_GET_ROUTES[request['path']](request)
+    if request['method'] == 'POST' and WEBHOOK_URL and request['path'] == WEBHOOK_PATH:
+        return await http_webhook(app, request)
+    return '404 Not Found', 'text/plain', b'not found'
+
+async def handle_http(app, reader, writer):
+    """Мінімальний HTTP/1.1 з keep-alive: вистачає для Telegram і health-check платформи"""
+    try:
+        while True:
+            request_line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE)
+            if not request_line:
+                break
+            method, target, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length > HTTP_MAX_BODY:
+                status, ctype, payload = '413 Payload Too Large', 'text/plain', b'too large'
+                keep_alive = False
+            else:
+                body = await reader.readexactly(length) if length else b''
+                request = {'method': method, 'path': target.split('?', 1)[0], 'headers': headers, 'body': body}
+                status, ctype, payload = await route_http(app, request)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def start_http_server(app):
+    return await asyncio.start_server(lambda r, w: handle_http(app, r, w), '0.0.0.0', HTTP_PORT)
+
+async def run_webhook(app):
+    """Режим webhook: життєвий цикл Application вручну, оновлення приходять через handle_http"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+        await app.start()
+        print(f"🌐 Webhook режим на порту {HTTP_PORT}")
+        await stop.wait()
+    finally:
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# Функції для роботи з базою даних
+@timed_db
+def get_shared_media_from_db(strict=False):
+    """Отримати СПІЛЬНУ бібліотеку медіа з БД і її версію.
+
+    Без БД - порожня бібліотека і версія None (strict - пробросити помилку).
+    """
+    media = {'checkin': [], 'checkout': []}
+    try:
+        with db_pool.cursor() as cur:
+            # Один знімок на обидва запити: версія відповідає саме прочитаним рядкам
+            cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cur.execute('SELECT id, kind, media_type, content, name FROM media_items ORDER BY kind, position, id')
+            for item_id, kind, media_type, content, name in cur.fetchall():
+                media[kind].append({'id': item_id, 'type': media_type, 'content': content, 'name': name})
+            cur.execute(LIBRARY_VERSION_SQL)
+            version = cur.fetchone()[0]
+        return media, version
+    except Exception as e:
+        if strict:
+            raise
+        print(f"❌ Помилка читання медіа: {e}")
+        return {'checkin': [], 'checkout': []}, None
+
+@timed_db
+def get_library_changes(after):
+    """Зміни бібліотеки після версії after у порядку версій: (нова версія, [(id, kind, елемент)]).
+
+    У видаленого елемента kind і елемент - None.
+    """
+    with db_pool.cursor() as cur:
+        cur.execute('''
+            SELECT id, kind, media_type, content, name, version FROM media_items WHERE version > %s
+            UNION ALL
+            SELECT item_id, NULL, NULL, NULL, NULL, version FROM media_deleted WHERE version > %s
+            ORDER BY version
+        ''', (after, after))
+        rows = cur.fetchall()
+    changes = [(item_id, kind, None if kind is None else {'id': item_id, 'type': media_type, 'content': content, 'name': name})
+               for item_id, kind, media_type, content, name, _ in rows]
+    return (rows[-1][5] if rows else after), changes
+
+@timed_db
+def get_library_version():
+    with db_pool.cursor() as cur:
+        cur.execute(LIBRARY_VERSION_SQL)
+        return cur.fetchone()[0]
+
+@timed_db
+def add_media_item_to_db(kind, item):
+    """Додати один елемент у бібліотеку; повертає елемент з id або None"""
+    try:
+        with db_pool.cursor() as cur:
+            cur.execute('''
+                INSERT INTO media_items (kind, position, media_type, content, name)
+                VALUES (%s, COALESCE((SELECT MAX(position) FROM media_items WHERE kind = %s), 0) + 1, %s, %s, %s)
+                RETURNING id
+            ''', (kind, kind, item['type'], item['content'], item.get('name', '')))
+            item_id = cur.fetchone()[0]
+        return {**item, 'id': item_id}
+    except Exception as e:
+        print(f"❌ Помилка збереження медіа: {e}")
+        return None
+
+@timed_db
+def delete_media_item_from_db(item_id):
+    """Видалити один елемент бібліотеки за id; True при успіху"""
+    try:
+        with db_pool.cursor() as cur:
+            cur.execute('DELETE FROM media_items WHERE id = %s', (item_id,))
+        return True
+    except Exception as e:
+        print(f"❌ Помилка видалення медіа: {e}")
+        return False
+
+@timed_db
+def get_user_status_from_db(user_id):
+    """Отримати статус користувача з БД"""
+    try:
+        with db_pool.cursor() as cur:
+            cur.execute('SELECT active, username, workload, chat_id FROM user_status WHERE user_id = %s', (user_id,))
+            result = cur.fetchone()
+        if result:
+            return {'active': result[0], 'username': result[1], 'workload': result[2], 'chat_id': result[3]}
+        return None
+    except Exception as e:
+        print(f"❌ Помилка читання статусу: {e}")
+        return None
+
+@timed_db
+def save_user_status_to_db(user_id, status):
+    """Зберегти статус користувача в БД"""
+    try:
+        with db_pool.cursor() as cur:
+            cur.execute('''
+                INSERT INTO user_status (user_id, active, username, workload, chat_id)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (user_id) 
+                DO UPDATE SET active = EXCLUDED.active, username = EXCLUDED.username, workload = EXCLUDED.workload,
+                              chat_id = COALESCE(EXCLUDED.chat_id, user_status.chat_id)
+            ''', (user_id, status['active'], status['username'], status.get('workload'), status.get('chat_id')))
+    except Exception as e:
+        print(f"❌ Помилка збереження статусу: {e}")
+
+REPORT_TIMEZONE = os.getenv('REPORT_TIMEZONE', 'UTC')  # день сесії рахується в цьому поясі
+
+@timed_db
+def save_user_statuses_to_db(statuses, events=(), applied=None):
+    """Зберегти пачку статусів одним multi-row upsert і дописати події в журнал; True при успіху.
+
+    Для подій, що закривають сесію (checkout/reset), тим же запитом оновлюється attendance_daily:
+    остання попередня подія користувача береться з індексу (user_id, occurred_at).
+    applied = (source, seq) з локального журналу: пачка з уже записаним seq пропускається.
+    """
+    rows = [(user_id, s['active'], s['username'], s.get('workload'), s.get('chat_id')) for user_id, s in statuses.items()]
+    try:
+        with db_pool.cursor() as cur:
+            if applied:
+                cur.execute('''
+                    INSERT INTO journal_applied (source, seq) VALUES (%s, %s)
+                    ON CONFLICT (source) DO UPDATE SET seq = EXCLUDED.seq, updated_at = now()
+                    WHERE journal_applied.seq < EXCLUDED.seq
+                    RETURNING seq
+                ''', applied)
+                if cur.fetchone() is None:
+                    return True
+            if rows:
+                execute_values(cur, '''
+                    INSERT INTO user_status (user_id, active, username, workload, chat_id)
+                    VALUES %s
+                    ON CONFLICT (user_id)
+                    DO UPDATE SET active = EXCLUDED.active, username = EXCLUDED.username, workload = EXCLUDED.workload,
+                                  chat_id = COALESCE(EXCLUDED.chat_id, user_status.chat_id)
+                ''', rows)
+            if events:
+                execute_values(cur, '''
+                    INSERT INTO attendance_events (user_id, chat_id, kind, workload, occurred_at) VALUES %s
+                ''', [(e['user_id'], e['chat_id'], e['kind'], e['workload'], e['occurred_at']) for e in events])
+                checkins = {}
+                for e in events:
+                    if e['kind'] == 'checkin':
+                        checkins[e['user_id']] = max(e['occurred_at'], checkins.get(e['user_id'], e['occurred_at']))
+                if checkins:
+                    execute_values(cur, '''
+                        UPDATE user_status u SET checked_in_at = c.occurred_at
+                        FROM (VALUES %s) AS c (user_id, occurred_at)
+                        WHERE u.user_id = c.user_id AND (u.checked_in_at IS NULL OR u.checked_in_at < c.occurred_at)
+                    ''', list(checkins.items()))
+                closing = [(e['user_id'], e['occurred_at'], REPORT_TIMEZONE) for e in events if e['kind'] != 'checkin']
+                if closing:
+                    execute_values(cur, '''
+                        WITH closing (user_id, occurred_at, tz) AS (VALUES %s)
+                        INSERT INTO attendance_daily (user_id, day, worked_seconds, sessions)
+                        SELECT user_id, day, SUM(seconds), COUNT(*) FROM (
+                            SELECT c.user_id, (s.occurred_at AT TIME ZONE c.tz)::date AS day,
+                                   EXTRACT(EPOCH FROM c.occurred_at - s.occurred_at)::bigint AS seconds
+                            FROM closing c
+                            CROSS JOIN LATERAL (
+                                SELECT e.kind, e.occurred_at FROM attendance_events e
+                                WHERE e.user_id = c.user_id
+                                  AND e.occurred_at < c.occurred_at
+                                  AND e.occurred_at >= c.occurred_at - INTERVAL '2 days'
+                                ORDER BY e.occurred_at DESC
+                                LIMIT 1
+                            ) s
+                            WHERE s.kind = 'checkin'
+                        ) sessions
+                        GROUP BY user_id, day
+                        ON CONFLICT (user_id, day) DO UPDATE
+                        SET worked_seconds = attendance_daily.worked_seconds + EXCLUDED.worked_seconds,
+                            sessions = attendance_daily.sessions + EXCLUDED.sessions
+                    ''', closing)
+        return True
+    except Exception as e:
+        print(f"❌ Помилка пакетного збереження статусів ({len(rows)}, подій {len(events)}): {e}")
+        return False
+
+@timed_db
+def get_attendance_report(since):
+    """Відпрацьовані секунди по користувачах і днях, починаючи з since (з attendance_daily)"""
+    try:
+        with db_pool.cursor() as cur:
+            cur.execute('''
+                SELECT d.user_id, COALESCE(u.username, d.user_id::text), d.day, d.worked_seconds
+                FROM attendance_daily d
+                LEFT JOIN user_status u ON u.user_id = d.user_id
+                WHERE d.day >= %s
+                ORDER BY 2, d.day
+            ''', (since,))
+            return cur.fetchall()
+    except Exception as e:
+        print(f"❌ Помилка читання звіту: {e}")
+        return None
+
+@timed_db
+def get_journal_applied(source):
+    """Останній seq журналу, вже записаний у Postgres (0 - нічого); None при помилці"""
+    try:
+        with db_pool.cursor() as cur:
+            cur.execute('SELECT seq FROM journal_applied WHERE source = %s', (source,))
+            row = cur.fetchone()
+        return row[0] if row else 0
+    except Exception as e:
+        print(f"❌ Помилка читання стану журналу: {e}")
+        return None
+
+@timed_db
+def get_all_user_statuses():
+    """Отримати всі статуси користувачів"""
+    try:
+        with db_pool.cursor() as cur:
+            cur.execute('SELECT user_id, active, username, workload, chat_id FROM user_status')
+            results = cur.fetchall()
+        statuses = {}
+        for row in results:
+            statuses[row[0]] = {'active': row[1], 'username': row[2], 'workload': row[3], 'chat_id': row[4]}
+        return statuses
+    except Exception as e:
+        print(f"❌ Помилка читання всіх статусів: {e}")
+        return {}
+
+@timed_db
+def reset_chat_statuses_in_db(chat_id):
+    """Скинути active для користувачів чату (chat_id = 0 - всі, чий чат не має свого розкладу)"""
+    with db_pool.cursor() as cur:
+        if chat_id:
+            cur.execute('UPDATE user_status SET active = FALSE WHERE active AND chat_id = %s', (chat_id,))
+        else:
+            # Чати з власним розкладом - з reset_schedule, а не з пам'яті: /resettime міг обробити інший процес
+            cur.execute('''
+                UPDATE user_status u SET active = FALSE
+                WHERE u.active AND (u.chat_id IS NULL OR NOT EXISTS (
+                    SELECT 1 FROM reset_schedule s WHERE s.chat_id = u.chat_id AND s.chat_id <> %s
+                ))
+            ''', (DEFAULT_RESET_CHAT,))
+        return cur.rowcount
+
+@timed_db
+def get_reset_schedules():
+    """Розклади скидання: chat_id -> (час, пояс, останнє скидання)"""
+    with db_pool.cursor() as cur:
+        cur.execute('SELECT chat_id, reset_time, timezone, last_reset_at FROM reset_schedule')
+        return {row[0]: (row[1], row[2], row[3]) for row in cur.fetchall()}
+
+@timed_db
+def save_reset_schedule(chat_id, reset_time, tz_name):
+    """Створити/змінити розклад; last_reset_at нового розкладу = зараз, щоб не скинути одразу"""
+    with db_pool.cursor() as cur:
+        cur.execute('''
+            INSERT INTO reset_schedule (chat_id, reset_time, timezone) VALUES (%s, %s, %s)
+            ON CONFLICT (chat_id) DO UPDATE SET reset_time = EXCLUDED.reset_time, timezone = EXCLUDED.timezone
+            RETURNING last_reset_at
+        ''', (chat_id, reset_time, tz_name))
+        return cur.fetchone()[0]
+
+@timed_db
+def claim_reset(chat_id, due):
+    """Позначити скидання як виконане; False якщо його вже зробив інший процес"""
+    with db_pool.cursor() as cur:
+        cur.execute('''
+            UPDATE reset_schedule SET last_reset_at = %s
+            WHERE chat_id = %s AND last_reset_at < %s
+        ''', (due, chat_id, due))
+        return cur.rowcount == 1
+
+@timed_db
+def get_due_users(active, since, until, after_user, limit):
+    """Пачка (user_id, checked_in_at) з check-in у [since, until), keyset після (since, after_user).
+
+    active обирає частковий індекс активних або повний; у шардованому режимі - тільки свої користувачі.
+    """
+    with db_pool.cursor() as cur:
+        cur.execute('''
+            SELECT user_id, checked_in_at FROM user_status
+            WHERE active = %s AND (checked_in_at, user_id) > (%s, %s) AND checked_in_at < %s
+              AND user_id %% %s = %s
+            ORDER BY checked_in_at, user_id
+            LIMIT %s
+        ''', (active, since, after_user, until, WORKER_COUNT, WORKER_INDEX, limit))
+        return cur.fetchall()
+
+@timed_db
+def get_oldest_active_checkin():
+    """Найраніший check-in серед активних (перший запис часткового індексу) або None"""
+    with db_pool.cursor() as cur:
+        cur.execute('SELECT MIN(checked_in_at) FROM user_status WHERE active AND user_id %% %s = %s',
+                    (WORKER_COUNT, WORKER_INDEX))
+        return cur.fetchone()[0]
+
+@timed_db
+def claim_reminders(kind, rows):
+    """Зафіксувати нагадування [(user_id, due)]; повертає id, яким це нагадування ще не надсилалось"""
+    if not rows:
+        return set()
+    with db_pool.cursor() as cur:
+        claimed = execute_values(cur, '''
+            INSERT INTO reminder_log (user_id, kind, due) VALUES %s
+            ON CONFLICT (user_id, kind) DO UPDATE SET due = EXCLUDED.due
+            WHERE reminder_log.due < EXCLUDED.due
+            RETURNING user_id
+        ''', [(user_id, kind, due) for user_id, due in rows], fetch=True)
+    return {row[0] for row in claimed}
+
+@timed_db
+def get_live_rosters():
+    """Живі списки команди: chat_id -> [message_id, ...]"""
+    with db_pool.cursor() as cur:
+        cur.execute('SELECT chat_id, message_ids FROM live_roster')
+        return {chat_id: list(message_ids) for chat_id, message_ids in cur.fetchall()}
+
+@timed_db
+def save_live_roster(chat_id, message_ids):
+    with db_pool.cursor() as cur:
+        cur.execute('''
+            INSERT INTO live_roster (chat_id, message_ids) VALUES (%s, %s)
+            ON CONFLICT (chat_id) DO UPDATE SET message_ids = EXCLUDED.message_ids
+        ''', (chat_id, message_ids))
+
+@timed_db
+def claim_live_roster(chat_id, stale_after):
+    """Зайняти чат під новий живий список; False - список уже є або його створює інший процес"""
+    with db_pool.cursor() as cur:
+        cur.execute('''
+            INSERT INTO live_roster (chat_id, message_ids) VALUES (%s, '{}')
+            ON CONFLICT (chat_id) DO UPDATE SET claimed_at = now()
+            WHERE live_roster.message_ids = '{}' AND live_roster.claimed_at < now() - %s * interval '1 second'
+            RETURNING chat_id
+        ''', (chat_id, stale_after))
+        return cur.fetchone() is not None
+
+@timed_db
+def delete_live_roster(chat_id):
+    with db_pool.cursor() as cur:
+        cur.execute('DELETE FROM live_roster WHERE chat_id = %s', (chat_id,))
+
+@timed_db
+def get_persisted_user_ids():
+    """Користувачі, для яких є збережений user_data; None якщо БД недоступна"""
     try:
-        return psycopg2.connect(os.getenv('DATABASE_URL'))
+        with db_pool.cursor() as cur:
+            cur.execute('SELECT user_id FROM bot_user_data')
+            return {row[0] for row in cur.fetchall()}
     except Exception as e:
-        print(f"❌ Помилка підключення до БД: {e}")
+        print(f"❌ Помилка читання списку user_data: {e}")
         return None
 
-def init_db():
-    """Ініціалізація таблиць бази даних"""
-    conn = get_db_connection()
-    if not conn:
-        return
-    try:
-        cur = conn.cursor()
-        # Таблиця для СПІЛЬНОЇ бібліотеки медіа (для всіх користувачів)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS shared_media (
-                id SERIAL PRIMARY KEY,
-                media_type TEXT NOT NULL,
-                checkin_media JSONB DEFAULT '[]',
-                checkout_media JSONB DEFAULT '[]'
-            )
-        ''')
-        # Перевіряємо чи є запис, якщо ні - створюємо
-        cur.execute('SELECT COUNT(*) FROM shared_media')
-        if cur.fetchone()[0] == 0:
-            cur.execute("INSERT INTO shared_media (media_type, checkin_media, checkout_media) VALUES ('shared', '[]', '[]')")
-        
-        # Таблиця для статусів користувачів
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS user_status (
-                user_id BIGINT PRIMARY KEY,
-                active BOOLEAN DEFAULT FALSE,
-                username TEXT,
-                workload TEXT
-            )
-        ''')
-        conn.commit()
-        cur.close()
-        conn.close()
-        print("✅ База даних ініціалізована")
-    except Exception as e:
-        print(f"❌ Помилка ініціалізації БД: {e}")
-        if conn:
-            conn.close()
-
-class SimpleHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(b'Bot running!')
-    def log_message(self, format, *args):
-        pass
+@timed_db
+def get_persisted_user_data(user_id):
+    """user_data одного користувача (з БД, при першому його оновленні)"""
+    with db_pool.cursor() as cur:
+        cur.execute('SELECT data FROM bot_user_data WHERE user_id = %s', (user_id,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+@timed_db
+def get_persisted_conversations(name):
+    """Незавершені діалоги ConversationHandler: ключ -> стан"""
+    try:
+        with db_pool.cursor() as cur:
+            cur.execute('SELECT key, state FROM bot_conversations WHERE name = %s', (name,))
+            return {tuple(json.loads(key)): state for key, state in cur.fetchall()}
+    except Exception as e:
+        print(f"❌ Помилка читання діалогів {name}: {e}")
+        return {}
+
+@timed_db
+def save_persistence_batch(users, conversations):
+    """Записати пачку user_data і станів діалогів однією транзакцією; None - видалити рядок"""
+    try:
+        with db_pool.cursor() as cur:
+            upserts = [(user_id, data) for user_id, data in users.items() if data is not None]
+            drops = [user_id for user_id, data in users.items() if data is None]
+            if upserts:
+                execute_values(cur, '''
+                    INSERT INTO bot_user_data (user_id, data) VALUES %s
+                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                ''', upserts)
+            if drops:
+                cur.execute('DELETE FROM bot_user_data WHERE user_id = ANY(%s)', (drops,))
+            states = [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+            ended = [(name, key) for (name, key), state in conversations.items() if state is None]
+            if states:
+                execute_values(cur, '''
+                    INSERT INTO bot_conversations (name, key, state) VALUES %s
+                    ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+                ''', states)
+            if ended:
+                execute_values(cur, '''
+                    DELETE FROM bot_conversations c USING (VALUES %s) AS e (name, key)
+                    WHERE c.name = e.name AND c.key = e.key
+                ''', ended)
+        return True
+    except Exception as e:
+        print(f"❌ Помилка збереження стану діалогів ({len(users)}, діалогів {len(conversations)}): {e}")
+        return False
+
+# Локальний журнал записів: пачки статусів переживають недоступність БД і перезапуск
+JOURNAL_PATH = os.getenv('JOURNAL_PATH', 'write_journal.sqlite3')  # воркери шардованого режиму - JOURNAL_PATH.N
+JOURNAL_REPLAY_BATCH = int(os.getenv('JOURNAL_REPLAY_BATCH', 50))  # пачок журналу на одну транзакцію в Postgres
+
+class WriteJournal:
+    """Журнал пачок статусів і подій у SQLite (WAL, synchronous=FULL - fsync на кожну пачку).
+
+    seq - порядковий номер пачки; разом з source (id цього журналу) він пишеться в journal_applied
+    тією ж транзакцією, що й дані, тому пачка, перенесена перед збоєм, вдруге не застосовується.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.source = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            path = self.path if PROCESS_ROLE != 'worker' else f'{self.path}.{WORKER_INDEX}'
+            conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries (seq INTEGER PRIMARY KEY AUTOINCREMENT, statuses TEXT NOT NULL, events TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('source', ?)", (secrets.token_hex(8),))
+            self.source = conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def append(self, statuses, events):
+        """Дописати пачку; повертає її seq"""
+        events = [{**e, 'occurred_at': e['occurred_at'].isoformat()} for e in events]
+        with self._lock:
+            cur = self._db().execute('INSERT INTO entries (statuses, events) VALUES (?, ?)',
+                                     (json.dumps(statuses, ensure_ascii=False), json.dumps(events, ensure_ascii=False)))
+            return cur.lastrowid
+
+    def read(self, limit, after=0):
+        """Найстаріші пачки: [(seq, статуси, події)]"""
+        with self._lock:
+            rows = self._db().execute('SELECT seq, statuses, events FROM entries WHERE seq > ? ORDER BY seq LIMIT ?',
+                                      (after, limit)).fetchall()
+        entries = []
+        for seq, statuses, events in rows:
+            events = [{**e, 'occurred_at': datetime.fromisoformat(e['occurred_at'])} for e in json.loads(events)]
+            entries.append((seq, {int(user_id): s for user_id, s in json.loads(statuses).items()}, events))
+        return entries
+
+    def ack(self, seq):
+        """Пачки до seq включно вже в Postgres"""
+        with self._lock:
+            self._db().execute('DELETE FROM entries WHERE seq <= ?', (seq,))
+
+    def count(self):
+        with self._lock:
+            return self._db().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def pending_statuses(self):
+        """Статуси з ще не перенесених пачок (новіші за БД): накладаються на кеш при старті"""
+        statuses = {}
+        for _, batch, _ in self.read(-1):
+            statuses.update(batch)
+        return statuses
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+# Один потік: SQLite-з'єднання журналу використовується послідовно
+journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+
+async def run_journal(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(journal_executor, functools.partial(func, *args))
+
+# Відкладений запис статусів
+STATUS_FLUSH_INTERVAL_MS = int(os.getenv('STATUS_FLUSH_INTERVAL_MS', 200))
+STATUS_FLUSH_MAX_BATCH = int(os.getenv('STATUS_FLUSH_MAX_BATCH', 100))
+
+class StatusWriteBehind:
+    """Черга відкладеного запису статусів: зміни зливаються по user_id і пишуться пачками.
+
+    Пачка спершу fsync'иться в локальний журнал, потім журнал переноситься в Postgres,
+    поки БД доступна; при недоступній БД пачки накопичуються в журналі.
+    """
+    def __init__(self, interval_ms, max_batch, journal):
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        self.journal = journal
+        self.pending = {}
+        self.events = []  # події журналу відміток; не зливаються, пишуться всі
+        self.journaled = 0  # пачки в локальному журналі, ще не перенесені в Postgres
+        self._applied = None  # останній seq журналу, відомий як записаний у Postgres
+        # Тримається під час запису в БД; reset_statuses бере його, щоб не перегнати flush
+        self.lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    @property
+    def depth(self):
+        return len(self.pending) + len(self.events)
+
+    def enqueue(self, user_id, status):
+        # Зберігаємо знімок: пізніша зміна того ж користувача замінює попередню
+        self.pending[user_id] = dict(status)
+        if len(self.pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def log_event(self, user_id, chat_id, kind, workload=None):
+        """Додати подію в журнал відміток; час фіксується зараз, а не при записі"""
+        self.events.append({'user_id': user_id, 'chat_id': chat_id, 'kind': kind,
+                            'workload': workload, 'occurred_at': datetime.now(timezone.utc)})
+        if len(self.events) >= self.max_batch:
+            self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        # Пачки, що лишились у журналі з попереднього запуску
+        self.journaled = await run_journal(self.journal.count)
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if self.pending or self.events:
+                batch, self.pending = self.pending, {}
+                events, self.events = self.events, []
+                try:
+                    await run_journal(self.journal.append, batch, events)
+                    self.journaled += 1
+                except Exception as e:
+                    print(f"❌ Помилка запису в локальний журнал: {e}")
+                    # Без журналу пишемо напряму, як раніше
+                    if not await self._write(batch, events):
+                        self._requeue(batch, events)
+            await self._replay()
+
+    async def _replay(self):
+        """Перенести журнал у Postgres пачками по JOURNAL_REPLAY_BATCH, поки БД доступна"""
+        while self.journaled and db_pool.breaker.ready():
+            if self._applied is None:
+                # Після перезапуску: пачки, записані в Postgres до збою, але не видалені з журналу
+                self._applied = await run_db(get_journal_applied, self.journal.source)
+                if self._applied is None:
+                    return
+            entries = await run_journal(self.journal.read, JOURNAL_REPLAY_BATCH, self._applied)
+            if not entries:
+                await run_journal(self.journal.ack, self._applied)
+                self.journaled = 0
+                return
+            batch, events = {}, []
+            for _, statuses, entry_events in entries:
+                batch.update(statuses)
+                events += entry_events
+            seq = entries[-1][0]
+            if not await self._write(batch, events, (self.journal.source, seq)):
+                return
+            self._applied = seq
+            await run_journal(self.journal.ack, seq)
+            self.journaled = max(0, self.journaled - len(entries))
+
+    async def _write(self, batch, events, applied=None):
+        started = monotonic()
+        ok = await run_db(save_user_statuses_to_db, batch, events, applied)
+        elapsed_ms = (monotonic() - started) * 1000
+        STATUS_FLUSH_SECONDS.observe(elapsed_ms / 1000)
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        if ok:
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+        else:
+            self.errors += 1
+        return ok
+
+    def _requeue(self, batch, events):
+        # Повертаємо в чергу; новіші зміни, що прийшли під час запису, мають пріоритет
+        for user_id, status in batch.items():
+            self.pending.setdefault(user_id, status)
+        self.events[:0] = events
+
+    async def stop(self):
+        """Зупинити фоновий запис, дописати все, що залишилось, і закрити журнал"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.depth:
+            print(f"❌ Не записано при зупинці: статусів {len(self.pending)}, подій {len(self.events)}")
+        if self.journaled:
+            print(f"⏸ У локальному журналі {self.journaled} пачок: будуть перенесені в БД після перезапуску")
+        await run_journal(self.journal.close)
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'journaled': self.journaled,
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'errors': self.errors,
+            'last_flush_ms': round(self.last_flush_ms, 1),
+            'max_flush_ms': round(self.max_flush_ms, 1),
+        }
+
+status_writer = StatusWriteBehind(STATUS_FLUSH_INTERVAL_MS, STATUS_FLUSH_MAX_BATCH, WriteJournal(JOURNAL_PATH))
+STATUS_FLUSH_SECONDS = Histogram('bot_status_flush_seconds', 'Час пакетного запису статусів')
+Gauge('bot_status_queue_depth', 'Статуси, що чекають запису в БД', func=lambda: status_writer.depth)
+Gauge('bot_journal_batches', 'Пачки в локальному журналі, ще не перенесені в БД', func=lambda: status_writer.journaled)
+Gauge('bot_db_circuit_open', 'Circuit breaker БД розімкнений', func=lambda: int(db_pool.breaker.is_open))
+
+# Стан діалогів і user_data в Postgres
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', 5))  # секунди між пакетними записами
+
+class PostgresPersistence(BasePersistence):
+    """Persistence для PTB у БД бота: тільки user_data і стани ConversationHandler.
+
+    Application віддає зміни раз на update_interval; тут вони тільки зливаються в pending,
+    а пишуться одним запитом, коли Application передав усі зміни інтервалу.
+    Незмінений user_data не пишеться. user_data читається при першому оновленні
+    користувача (refresh_user_data), а не весь при старті.
+    """
+    def __init__(self, update_interval):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.users = {}  # user_id -> JSON user_data або None (видалити)
+        self.conversations = {}  # (name, JSON ключа) -> стан або None (діалог завершено)
+        self._written = {}  # user_id -> останній записаний/прочитаний JSON
+        self._stored = None  # user_id з рядком у БД; None - невідомо, питаємо БД
+        self._loaded = set()
+        self.lock = asyncio.Lock()
+        self._task = None
+        self.writes = 0
+        self.errors = 0
+
+    @property
+    def depth(self):
+        return len(self.users) + len(self.conversations)
+
+    async def get_user_data(self):
+        # Тільки список id: самі дані підтягне refresh_user_data, коли користувач напише
+        self._stored = await run_db(get_persisted_user_ids)
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return await run_db(get_persisted_conversations, name)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded:
+            return
+        if self._stored is not None and user_id not in self._stored:
+            self._loaded.add(user_id)
+            return
+        try:
+            data = await run_db(get_persisted_user_data, user_id)
+        except Exception as e:
+            print(f"❌ Помилка читання user_data {user_id}: {e}")
+            return
+        self._loaded.add(user_id)
+        if data:
+            self._written[user_id] = json.dumps(data, sort_keys=True)
+            # Те, що хендлер уже встиг записати, новіше за збережене
+            for key, value in data.items():
+                user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        payload = json.dumps(data, sort_keys=True)
+        # Application позначає брудним кожного, хто писав боту; пишемо тільки реальні зміни
+        if payload == self._written.get(user_id, '{}'):
+            self.users.pop(user_id, None)
+            return
+        self.users[user_id] = payload
+        self._schedule()
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._written or self._stored is None or user_id in self._stored:
+            self.users[user_id] = None
+            self._schedule()
+
+    async def update_conversation(self, name, key, new_state):
+        self.conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        # Даємо Application передати решту змін інтервалу - вони підуть тим же записом
+        await asyncio.sleep(0)
+        async with self.lock:
+            if not self.depth:
+                return
+            users, self.users = self.users, {}
+            conversations, self.conversations = self.conversations, {}
+            if await run_db(save_persistence_batch, users, conversations):
+                self.writes += 1
+                for user_id, payload in users.items():
+                    if payload is None:
+                        self._written.pop(user_id, None)
+                        if self._stored is not None:
+                            self._stored.discard(user_id)
+                    else:
+                        self._written[user_id] = payload
+                        if self._stored is not None:
+                            self._stored.add(user_id)
+            else:
+                self.errors += 1
+                # Повториться з наступним записом; новіші зміни мають пріоритет
+                for user_id, payload in users.items():
+                    self.users.setdefault(user_id, payload)
+                for key, state in conversations.items():
+                    self.conversations.setdefault(key, state)
+
+    async def flush(self):
+        """Викликається з Application.stop після останнього update_persistence"""
+        await self._write()
+        if self.depth:
+            print(f"❌ Не записано при зупинці: user_data {len(self.users)}, діалогів {len(self.conversations)}")
+
+persistence = None
+Gauge('bot_persistence_queue_depth', 'user_data і стани діалогів, що чекають запису в БД',
+      func=lambda: persistence.depth if persistence else 0)
+
+# Вихідні виклики Telegram: token bucket на чат і глобально, пріоритети, повтор після RetryAfter
+# roster - редагування живих списків команди: найнижчий пріоритет, не заважають оголошенням
+PRIORITY_ANSWER, PRIORITY_ANNOUNCE, PRIORITY_CLEANUP, PRIORITY_ROSTER = range(4)
+LANE_NAMES = ('answer', 'announce', 'cleanup', 'roster')
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', 25))  # викликів/с на весь бот
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))  # викликів/с на чат
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', 3))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', 8))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 3))
+
+OUTBOUND_QUEUE_WAIT = Histogram('bot_outbound_queue_wait_seconds', 'Очікування в черзі вихідних викликів (включно з лімітами)', ['lane'])
+OUTBOUND_RETRY_AFTER = Counter('bot_outbound_retry_after_total', 'Отримані RetryAfter', ['lane'])
+OUTBOUND_FAILURES = Counter('bot_outbound_failures_total', 'Вихідні виклики, що завершились помилкою', ['lane'])
+
+class TokenBucket:
+    """Token bucket з резервуванням: кожен виклик забирає токен і отримує, скільки чекати"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def reserve(self):
+        now = self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def delay(self):
+        """Скільки чекати до вільного токена (токен не забирається)"""
+        now = self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate, self.blocked_until - now)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Telegram попросив зачекати (RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+
+class OutboundScheduler:
+    """Черга вихідних викликів з пріоритетами: відповіді на кнопки, потім повідомлення, потім прибирання.
+
+    Виклик у чат з вичерпаним лімітом не тримає воркер: він відкладається в чергу свого чату
+    до появи токена, а воркер бере наступний. Глобальний токен береться перед самим викликом.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = None
+        self._seq = 0
+        self._tasks = []
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.parked = {}  # chat_id -> heap відкладених (пріоритет, seq, job)
+        self._timers = {}  # chat_id -> таймер повернення голови черги чату
+
+    def start(self):
+        if self._tasks:
+            return
+        self.queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @property
+    def depth(self):
+        if not self.queue:
+            return 0
+        return self.queue.qsize() + sum(len(parked) for parked in self.parked.values())
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+        return bucket
+
+    def submit(self, priority, chat_id, func, /, *args, **kwargs):
+        """Поставити виклик у чергу; повертає Future з результатом"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        # Спан оновлення, що поставило виклик: виклик Bot API потрапить у його трейс; останнє - номер спроби
+        job = [chat_id, func, args, kwargs, future, monotonic(), _current_span.get(), 0]
+        entry = (priority, self._seq, job)
+        if priority != PRIORITY_ANSWER and chat_id in self.parked:
+            # У чату вже є відкладені виклики: новий стає за ними, порядок у чаті зберігається
+            heapq.heappush(self.parked[chat_id], entry)
+        else:
+            self.queue.put_nowait(entry)
+        return future
+
+    def throttled(self, priority, chat_id):
+        """Чи виклик відкладеться в чергу чату: у чату вже є відкладені або вичерпано ліміт"""
+        if priority == PRIORITY_ANSWER or chat_id is None:
+            return False
+        return chat_id in self.parked or self._chat_bucket(chat_id).delay() > 0
+
+    async def call(self, priority, chat_id, func, /, *args, **kwargs):
+        throttled = self.throttled(priority, chat_id)
+        future = self.submit(priority, chat_id, func, *args, **kwargs)
+        if not throttled:
+            return await future
+        # Виклик чекатиме токена чату: слот обробки оновлень на цей час віддається іншим чатам
+        async with update_slot_released():
+            return await future
+
+    def fire(self, priority, chat_id, func, /, *args, **kwargs):
+        """Поставити виклик у чергу без очікування; помилки рахуються в метриках"""
+        future = self.submit(priority, chat_id, func, *args, **kwargs)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def _park(self, entry, delay):
+        chat_id = entry[2][0]
+        heapq.heappush(self.parked.setdefault(chat_id, []), entry)
+        self._arm(chat_id, delay)
+
+    def _arm(self, chat_id, delay):
+        if chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.get_running_loop().call_later(delay, self._unpark, chat_id)
+
+    def _unpark(self, chat_id):
+        """Токен чату з'явився: голова черги чату повертається в загальну чергу"""
+        del self._timers[chat_id]
+        parked = self.parked.get(chat_id)
+        if not parked:
+            return
+        self.queue.put_nowait(heapq.heappop(parked))
+        if not parked:
+            del self.parked[chat_id]
+
+    async def _worker(self):
+        while True:
+            entry = await self.queue.get()
+            priority, _, job = entry
+            chat_id = job[0]
+            try:
+                # Відповіді на кнопки не є повідомленнями в чат, ліміт чату на них не діє
+                bucket = self._chat_bucket(chat_id) if chat_id is not None and priority != PRIORITY_ANSWER else None
+                if bucket:
+                    wait = bucket.delay()
+                    if wait:
+                        self._park(entry, wait)
+                        continue
+                    bucket.take()
+                    if chat_id in self.parked:
+                        self._arm(chat_id, bucket.delay())
+                token = _current_span.set(job[6])
+                try:
+                    retry = await self._execute(priority, bucket, job)
+                finally:
+                    _current_span.reset(token)
+                if retry:
+                    # RetryAfter: чат заблоковано - виклик чекає першим у черзі свого чату
+                    if bucket:
+                        self._park(entry, bucket.delay())
+                    else:
+                        self.queue.put_nowait(entry)
+            except Exception as e:
+                print(f"❌ Помилка черги вихідних викликів: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _execute(self, priority, bucket, job):
+        """Одна спроба виклику; True - повторити після RetryAfter"""
+        chat_id, func, args, kwargs, future, enqueued, _, attempt = job
+        lane = LANE_NAMES[priority]
+        wait = self.global_bucket.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        if attempt == 0:
+            OUTBOUND_QUEUE_WAIT.observe(monotonic() - enqueued, lane=lane)
+            record_span(f'queue.{lane}', 'queue', enqueued)
+        try:
+            result = await func(*args, **kwargs)
+        except RetryAfter as e:
+            OUTBOUND_RETRY_AFTER.inc(lane=lane)
+            (bucket or self.global_bucket).block(float(e.retry_after))
+            if attempt < OUTBOUND_MAX_RETRIES:
+                job[7] += 1
+                return True
+            error = e
+        except Exception as e:
+            error = e
+        else:
+            if not future.done():
+                future.set_result(result)
+            return False
+        OUTBOUND_FAILURES.inc(lane=lane)
+        if not future.done():
+            future.set_exception(error)
+        return False
+
+    async def drain(self):
+        """Дочекатися, поки черга і відкладені виклики чатів спорожніють"""
+        while True:
+            await self.queue.join()
+            if not self.parked:
+                return
+            await asyncio.sleep(0.05)
+
+    async def stop(self, timeout=5):
+        """Дочекатися черги (не довше timeout) і зупинити воркери"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f"❌ Не відправлено при зупинці: {self.depth}")
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+outbound = OutboundScheduler(OUTBOUND_WORKERS)
+Gauge('bot_outbound_queue_depth', 'Вихідні виклики в черзі', func=lambda: outbound.depth)
+
+_answered_queries = {}  # id callback query -> None; повторна відповідь Telegram повертає помилку
+
+async def answer(update, *args, **kwargs):
+    """Відповісти на callback query (найвищий пріоритет); повторні відповіді ігноруються"""
+    query_id = update.callback_query.id
+    if query_id in _answered_queries:
+        return False
+    _answered_queries[query_id] = None
+    if len(_answered_queries) > 1000:
+        del _answered_queries[next(iter(_answered_queries))]
+    return await outbound.call(PRIORITY_ANSWER, update.effective_chat.id, update.callback_query.answer, *args, **kwargs)
+
+async def acknowledge(update, text, error=False):
+    """Відповідь на кнопку; на команду - окреме повідомлення тільки про помилку (успіх видно з оголошення)"""
+    if update.callback_query:
+        await answer(update, text)
+    elif error:
+        await send(update.effective_chat.id, update.get_bot().send_message, text=text)
+
+async def send(chat_id, method, **kwargs):
+    """Надіслати повідомлення в чат через чергу: send(chat_id, bot.send_message, text=...)"""
+    return await outbound.call(PRIORITY_ANNOUNCE, chat_id, method, chat_id=chat_id, **kwargs)
+
+async def reply(update, text, **kwargs):
+    return await outbound.call(PRIORITY_ANNOUNCE, update.effective_chat.id, update.message.reply_text, text, **kwargs)
+
+# Прибирання повідомлень: id збираються по чатах і видаляються одним deleteMessages
+CLEANUP_BATCH = 100  # ліміт deleteMessages на виклик
+CLEANUP_MESSAGES = Counter('bot_cleanup_messages_total', 'Повідомлення, поставлені на видалення, за результатом', ['result'])
+
+class MessageCleanup:
+    """Пачки видалень по чатах: на чат у черзі один виклик, і поки він чекає, нові id дописуються в нього"""
+    def __init__(self):
+        self.pending = {}  # chat_id -> [message_id]
+
+    @property
+    def depth(self):
+        return sum(len(ids) for ids in self.pending.values())
+
+    def add(self, bot, chat_id, message_id):
+        if chat_id not in self.pending:
+            self.pending[chat_id] = []
+            self._schedule(bot, chat_id)
+        self.pending[chat_id].append(message_id)
+
+    def _schedule(self, bot, chat_id):
+        batch = []
+
+        async def delete():
+            # Пачка забирається при першій спробі; повтор після RetryAfter видаляє ту саму
+            if not batch:
+                ids = self.pending.pop(chat_id, [])
+                batch.extend(ids[:CLEANUP_BATCH])
+                if len(ids) > CLEANUP_BATCH:
+                    self.pending[chat_id] = ids[CLEANUP_BATCH:]
+                    self._schedule(bot, chat_id)
+            return await bot.delete_messages(chat_id, batch)
+
+        def done(future):
+            if not future.cancelled():
+                CLEANUP_MESSAGES.inc(len(batch), result='failed' if future.exception() else 'deleted')
+
+        outbound.submit(PRIORITY_CLEANUP, chat_id, delete).add_done_callback(done)
+
+cleanup = MessageCleanup()
+Gauge('bot_cleanup_pending', 'Повідомлення, що чекають видалення', func=lambda: cleanup.depth)
+
+def delete_later(message):
+    """Видалити повідомлення у фоні з найнижчим пріоритетом, пачкою з іншими з того ж чату"""
+    # Кнопки під повідомленнями старшими за 48 год приходять з InaccessibleMessage: без chat_id, і видалити не можна
+    if message is not None and message.is_accessible:
+        cleanup.add(message.get_bot(), message.chat.id, message.message_id)
+
+user_status = {}
+shared_media = {'checkin': [], 'checkout': []}  # Спільна бібліотека для всіх
+WORKLOAD = {'🟢': 'Потрібні задачі', '🟡': 'Середня завантаженість', '🔴': 'Завантаженість до пенсії'}
+
+ROSTER_RECONCILE_INTERVAL = int(os.getenv('ROSTER_RECONCILE_INTERVAL', 300))  # секунди
+# Воркери бачать зміни чужих користувачів тільки через БД, тому звіряються частіше
+SHARD_RECONCILE_INTERVAL = int(os.getenv('SHARD_RECONCILE_INTERVAL', 5))
+
+ROSTER_MESSAGE_LIMIT = 4096  # ліміт тексту повідомлення Telegram
+ROSTER_EDIT_DEBOUNCE = float(os.getenv('ROSTER_EDIT_DEBOUNCE', 3))  # секунди: зміни за вікно - одне редагування
+ROSTER_CLAIM_TIMEOUT = 60  # секунди: після цього незавершене створення живого списку можна перехопити
+
+class RosterIndex:
+    """Індекс команди в пам'яті: хто на роботі (по кошиках завантаженості) і хто ні.
+
+    Оновлюється точково при check-in/check-out/скиданні, тому /team лише склеює готові рядки.
+    """
+    def __init__(self):
+        # Кошики онлайн: workload (або None) -> {user_id: рядок}; порядок кошиків фіксований
+        self.online = {w: {} for w in (*WORKLOAD, None)}
+        self.offline = {}
+        self._where = {}  # user_id -> кошик, де зараз лежить користувач
+
+    def __len__(self):
+        return len(self._where)
+
+    def _remove(self, user_id):
+        bucket = self._where.pop(user_id, None)
+        if bucket is not None:
+            bucket.pop(user_id, None)
+
+    def update(self, user_id, status):
+        self._remove(user_id)
+        if status['active']:
+            workload = status.get('workload')
+            if workload in WORKLOAD:
+                line = f"{workload} {status['username']} - {WORKLOAD[workload]}"
+            else:
+                workload = None
+                line = f"✅ {status['username']}"
+            bucket = self.online[workload]
+        else:
+            line = f"⭕ {status['username']}"
+            bucket = self.offline
+        bucket[user_id] = line
+        self._where[user_id] = bucket
+
+    def rebuild(self, statuses):
+        self.__init__()
+        for user_id, status in statuses.items():
+            self.update(user_id, status)
+
+    def active_ids(self):
+        """Користувачі на роботі, без проходу по офлайн"""
+        return [user_id for bucket in self.online.values() for user_id in bucket]
+
+    def render(self):
+        if not self._where:
+            return "📊 Немає даних"
+        online = [line for bucket in self.online.values() for line in bucket.values()]
+        msg = "👥 Команда:\n\n"
+        if online: msg += "🟢 На роботі:\n" + "\n".join(online) + "\n\n"
+        if self.offline: msg += "🔴 Не на роботі:\n" + "\n".join(self.offline.values())
+        return msg
+
+    def pages(self, limit=ROSTER_MESSAGE_LIMIT):
+        """render(), розбитий по рядках на частини не довші за limit (у UTF-16, як рахує Telegram: емодзі - 2)"""
+        pages, current = [], ''
+        for line in self.render().rstrip().split('\n'):
+            candidate = f'{current}\n{line}' if current else line
+            if len(candidate.encode('utf-16-le')) // 2 > limit and current:
+                pages.append(current.rstrip())
+                current = line
+            else:
+                current = candidate
+        pages.append(current)
+        return pages
+
+roster = RosterIndex()
+
+class LiveRoster:
+    """Закріплений список команди в чатах, що оновлюється редагуванням, а не новими повідомленнями.
+
+    Тільки групові чати; у приватному "Команда" - звичайне одноразове повідомлення.
+    Зміни статусів за ROSTER_EDIT_DEBOUNCE зливаються в одне редагування на повідомлення,
+    а нове оновлення не починається, поки не закінчилось попереднє. Великий список іде
+    кількома повідомленнями, закріплюється перше. У шардованому режимі чат редагує тільки
+    процес, якому він належить (owns_user по chat_id).
+    """
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self.chats = {}  # chat_id -> [message_id, ...]; порожній - список саме створюється
+        self.texts = {}  # (chat_id, message_id) -> останній виставлений текст
+        self.bot = None
+        self._task = None
+        self._dirty = False
+        self._creating = set()  # чати, у які цей процес зараз надсилає список
+
+    def reserve(self, chat_id):
+        """Зайняти чат під новий список до першого await; False - список уже є або створюється.
+
+        Порожній запис без локального створення - чужа заявка з БД: її перевірить claim_live_roster.
+        """
+        if self.chats.get(chat_id) or chat_id in self._creating:
+            return False
+        self.chats[chat_id] = []
+        self._creating.add(chat_id)
+        return True
+
+    def start(self, bot):
+        self.bot = bot
+        asyncio.create_task(self.load())
+
+    async def load(self):
+        try:
+            chats = await run_db(get_live_rosters)
+        except Exception as e:
+            print(f"❌ Помилка читання живих списків команди: {e}")
+            return
+        # id приватних чатів додатні: такі списки лишились від старих версій і більше не ведуться
+        for chat_id in [chat_id for chat_id in chats if chat_id > 0]:
+            del chats[chat_id]
+            await self._save(delete_live_roster, chat_id)
+        # Списки, які цей процес саме надсилає, лишаються тими самими об'єктами: create дописує в них id
+        chats.update({chat_id: self.chats[chat_id] for chat_id in self._creating})
+        self.chats = chats
+
+    def mark_dirty(self):
+        """Статуси змінились: оновити списки після вікна debounce (одне оновлення на вікно)"""
+        if not (self.chats and self.bot):
+            return
+        self._dirty = True
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_later())
+
+    async def _refresh_later(self):
+        # Зміни під час оновлення не запускають паралельне: їх підхопить наступне вікно
+        try:
+            while self._dirty:
+                await asyncio.sleep(self.debounce)
+                self._dirty = False
+                pages = roster.pages()
+                await asyncio.gather(*(self._sync(chat_id, pages) for chat_id in list(self.chats) if owns_user(chat_id)))
+        finally:
+            self._task = None
+
+    async def create(self, chat_id):
+        """Надіслати список у чат, зарезервований reserve, закріпити і надалі редагувати"""
+        ids = self.chats[chat_id]
+        claimed = False
+        try:
+            try:
+                claimed = await run_db(claim_live_roster, chat_id, ROSTER_CLAIM_TIMEOUT)
+            except Exception as e:
+                # Без БД інші процеси теж не створять список: досить локального резерву
+                print(f"❌ Помилка заявки на живий список команди: {e}")
+                claimed = True
+            if not claimed:
+                return
+            try:
+                for text in roster.pages():
+                    message = await send(chat_id, self.bot.send_message, text=text)
+                    # id записується відразу: якщо наступна частина не піде, надіслані не загубляться
+                    ids.append(message.message_id)
+                    self.texts[(chat_id, message.message_id)] = text
+                    await self._save(save_live_roster, chat_id, ids)
+            except TelegramError as e:
+                # Решту частин надішле наступне оновлення списку
+                print(f"❌ Помилка надсилання списку команди (чат {chat_id}): {e}")
+        finally:
+            self._creating.discard(chat_id)
+            if not ids:
+                self.drop(chat_id)
+                if claimed:
+                    await self._save(delete_live_roster, chat_id)
+        if not ids:
+            return
+        # Зміни статусів під час надсилання _sync пропустив: звірити список після вікна debounce
+        self.mark_dirty()
+        try:
+            await outbound.call(PRIORITY_ANNOUNCE, chat_id, self.bot.pin_chat_message, chat_id, ids[0], disable_notification=True)
+        except TelegramError as e:
+            print(f"📌 Не вдалося закріпити список команди (чат {chat_id}): {e}")
+
+    async def _sync(self, chat_id, pages):
+        ids = self.chats.get(chat_id)
+        if not ids or chat_id in self._creating:
+            return
+        count = len(ids)
+        try:
+            for message_id, text in zip(ids, pages):
+                if self.texts.get((chat_id, message_id)) != text:
+                    await self._edit(chat_id, message_id, text)
+            for text in pages[count:]:
+                message = await outbound.call(PRIORITY_ROSTER, chat_id, self.bot.send_message, chat_id=chat_id, text=text)
+                ids.append(message.message_id)
+                self.texts[(chat_id, message.message_id)] = text
+        except BadRequest as e:
+            # Повідомлення видалили або бот більше не в чаті: наступне "Команда" створить новий список
+            print(f"❌ Живий список команди (чат {chat_id}) більше недоступний: {e}")
+            self.drop(chat_id)
+            await self._save(delete_live_roster, chat_id)
+            return
+        except TelegramError as e:
+            # Текст не запам'ятали, тож наступна зміна повторить редагування
+            print(f"❌ Помилка оновлення списку команди (чат {chat_id}): {e}")
+        else:
+            for message_id in ids[len(pages):]:
+                cleanup.add(self.bot, chat_id, message_id)
+                self.texts.pop((chat_id, message_id), None)
+            del ids[len(pages):]
+        if len(ids) != count:
+            await self._save(save_live_roster, chat_id, ids)
+
+    async def _save(self, helper, *args):
+        try:
+            await run_db(helper, *args)
+        except Exception as e:
+            print(f"❌ Помилка збереження живого списку команди: {e}")
+
+    async def _edit(self, chat_id, message_id, text):
+        try:
+            await outbound.call(PRIORITY_ROSTER, chat_id, self.bot.edit_message_text, text,
+                                chat_id=chat_id, message_id=message_id)
+        except BadRequest as e:
+            # Після перезапуску кеш текстів порожній: такий самий текст - не помилка
+            if 'not modified' not in e.message.lower():
+                raise
+        self.texts[(chat_id, message_id)] = text
+
+    def drop(self, chat_id):
+        for message_id in self.chats.pop(chat_id, ()):
+            self.texts.pop((chat_id, message_id), None)
+
+live_roster = LiveRoster(ROSTER_EDIT_DEBOUNCE)
+
+Gauge('bot_users', 'Відомі користувачі', func=lambda: len(user_status))
+Gauge('bot_active_users', 'Користувачі на роботі', func=lambda: len(roster) - len(roster.offline))
+Gauge('bot_library_items', 'Розмір бібліотеки медіа', ['kind'], func=lambda: {(k,): len(v) for k, v in shared_media.items()})
+
+def set_user_status(user_id, status, chat_id=None):
+    """Єдина точка зміни статусу: пам'ять, індекс команди, журнал відміток і відкладений запис в БД"""
+    was_active = user_status.get(user_id, {}).get('active', False)
+    user_status[user_id] = status
+    roster.update(user_id, status)
+    live_roster.mark_dirty()
+    status_writer.enqueue(user_id, status)
+    if status['active'] != was_active:
+        status_writer.log_event(user_id, chat_id, 'checkin' if status['active'] else 'checkout', status.get('workload'))
+
+async def reconcile_roster():
+    """Звірити статуси в пам'яті з БД і підтягнути зміни, зроблені повз бота"""
+    # Під lock записувача: усе, що вже пішло в БД, видно, а ще не записане пропускаємо
+    async with status_writer.lock:
+        if status_writer.journaled:
+            # БД ще не наздогнала локальний журнал: пам'ять новіша
+            return
+        db_statuses = await run_db(get_all_user_statuses)
+    drift = 0
+    for user_id, status in db_statuses.items():
+        if user_id in status_writer.pending:
+            continue
+        if user_status.get(user_id) != status:
+            user_status[user_id] = status
+            roster.update(user_id, status)
+            drift += 1
+    if drift:
+        live_roster.mark_dirty()
+        print(f"🔄 Звірка команди: виправлено {drift} статусів")
+
+async def refresh_library():
+    """Підтягнути з БД зміни бібліотеки після завантаженої версії (ще не завантажена - прочитати цілком)"""
+    async with library_lock:
+        if library_db_version is None:
+            set_library(*await run_db(get_shared_media_from_db, strict=True))
+            return
+        version, changes = await run_db(get_library_changes, library_db_version)
+        apply_library_changes(version, changes)
+
+class LibraryListener:
+    """Узгодженість бібліотеки між процесами: LISTEN на окремому з'єднанні поза пулом.
+
+    NOTIFY шле тригер media_items, тож видно і зміни інших процесів, і ручні правки в БД.
+    Поки з'єднання немає, раз на poll_interval порівнюється версія і пробуємо перепідключитись.
+    """
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.conn = None
+        self._fd = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self._close()
+
+    def _connect(self):
+        conn = psycopg2.connect(db_pool.dsn, connect_timeout=DB_CONNECT_TIMEOUT,
+                                keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN {LIBRARY_CHANNEL}')
+        return conn
+
+    async def _listen(self):
+        if db_pool.breaker.is_open:
+            return False
+        try:
+            self.conn = await run_db(self._connect)
+        except psycopg2.Error as e:
+            print(f"❌ LISTEN бібліотеки недоступний: {e}")
+            return False
+        self._fd = self.conn.fileno()
+        asyncio.get_running_loop().add_reader(self._fd, self._on_readable)
+        return True
+
+    def _on_readable(self):
+        try:
+            self.conn.poll()
+        except psycopg2.Error as e:
+            print(f"🔌 LISTEN бібліотеки втрачено: {e}; перевірка версії раз на {self.poll_interval} с")
+            self._close()
+            return
+        if self.conn.notifies:
+            self.conn.notifies.clear()
+            self._wake.set()
+
+    def _close(self):
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._fd = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def _changed(self):
+        try:
+            return await run_db(get_library_version) != library_db_version
+        except Exception as e:
+            print(f"❌ Помилка перевірки версії бібліотеки: {e}")
+            return False
+
+    async def _run(self):
+        while True:
+            if self.conn is None and await self._listen():
+                # Сповіщення, що прийшли без з'єднання, втрачено: звіряємось одразу
+                self._wake.set()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                if self.conn is not None or not await self._changed():
+                    continue
+            self._wake.clear()
+            try:
+                await refresh_library()
+            except Exception as e:
+                print(f"❌ Помилка оновлення бібліотеки: {e}")
+
+LIBRARY_POLL_INTERVAL = int(os.getenv('LIBRARY_POLL_INTERVAL', 30))  # секунди, поки LISTEN недоступний
+library_listener = LibraryListener(LIBRARY_POLL_INTERVAL)
+Gauge('bot_library_listening', 'LISTEN бібліотеки підключено', func=lambda: int(library_listener.conn is not None))
+
+async def schedule_roster_reconcile():
+    """Періодична звірка індексу команди (і живих списків у воркерах) з БД"""
+    interval = SHARD_RECONCILE_INTERVAL if PROCESS_ROLE == 'worker' else ROSTER_RECONCILE_INTERVAL
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile_roster()
+            # Розклади скидання, змінені /resettime в інших процесах
+            await reset_scheduler.reload()
+            if PROCESS_ROLE == 'worker':
+                # Живі списки, створені в чатах цього воркера іншими воркерами
+                await live_roster.load()
+        except Exception as e:
+            print(f"❌ Помилка звірки команди: {e}")
+
+WARMUP_RETRY_INTERVAL = 10  # секунди між спробами, якщо БД була недоступна при старті
+
+async def retry_warm_up():
+    """Дочекатися БД і догрузити кеші, якщо старт пройшов без неї"""
+    while not is_ready():
+        await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+        if not await run_db(db_pool.ping):
+            continue
+        await run_db(init_db)
+        async with library_lock:
+            set_library(*await run_db(get_shared_media_from_db))
+        # Статуси, змінені поки БД була недоступна, в пам'яті (і в журналі) новіші
+        for user_id, status in (await run_db(get_all_user_statuses)).items():
+            if user_id not in user_status:
+                user_status[user_id] = status
+                roster.update(user_id, status)
+        readiness['db'] = readiness['caches'] = True
+        live_roster.mark_dirty()
+        print("✅ БД доступна, кеші завантажено")
+
+# Скидання статусів: розклад на чат (час + часовий пояс), черга на min-heap
+RESET_TIME = os.getenv('RESET_TIME', '00:00')  # розклад за замовчуванням
+RESET_TIMEZONE = os.getenv('RESET_TIMEZONE', 'UTC')
+DEFAULT_RESET_CHAT = 0
+
+def parse_reset_time(value):
+    hours, minutes = value.split(':')
+    return time(int(hours), int(minutes))
+
+def previous_reset(reset_time, tz_name, now):
+    """Останній запланований момент скидання, що не пізніше now (UTC)"""
+    tz = ZoneInfo(tz_name)
+    local_now = now.astimezone(tz)
+    due = datetime.combine(local_now.date(), reset_time, tzinfo=tz)
+    if due > local_now:
+        due = datetime.combine(local_now.date() - timedelta(days=1), reset_time, tzinfo=tz)
+    return due.astimezone(timezone.utc)
+
+def next_reset(reset_time, tz_name, after):
+    """Наступний момент скидання строго після after (UTC)"""
+    tz = ZoneInfo(tz_name)
+    last = previous_reset(reset_time, tz_name, after).astimezone(tz)
+    return datetime.combine(last.date() + timedelta(days=1), reset_time, tzinfo=tz).astimezone(timezone.utc)
+
+class ResetScheduler:
+    """Скидання статусів за розкладом кожного чату.
+
+    Найближчі скидання лежать у min-heap (час, chat_id); застарілі записи пропускаються при pop.
+    Пропущені під час простою скидання виконуються одразу після старту.
+    """
+    def __init__(self):
+        self.schedules = {}  # chat_id -> (час, пояс)
+        self.due = {}  # chat_id -> актуальний час наступного скидання
+        self.heap = []
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def _push(self, chat_id, due):
+        self.due[chat_id] = due
+        heapq.heappush(self.heap, (due, chat_id))
+        self._changed.set()
+
+    async def load(self):
+        await run_db(save_reset_schedule, DEFAULT_RESET_CHAT, parse_reset_time(RESET_TIME), RESET_TIMEZONE)
+        now = datetime.now(timezone.utc)
+        for chat_id, (reset_time, tz_name, last_reset_at) in (await run_db(get_reset_schedules)).items():
+            self.schedules[chat_id] = (reset_time, tz_name)
+            missed = previous_reset(reset_time, tz_name, now)
+            # Якщо останнє скидання було до останнього запланованого - ми його проспали
+            self._push(chat_id, missed if last_reset_at < missed else next_reset(reset_time, tz_name, now))
+
+    async def reload(self):
+        """Підтягнути розклади, змінені іншими процесами; змінений розклад планується заново"""
+        now = datetime.now(timezone.utc)
+        for chat_id, (reset_time, tz_name, _) in (await run_db(get_reset_schedules)).items():
+            if self.schedules.get(chat_id) != (reset_time, tz_name):
+                self.schedules[chat_id] = (reset_time, tz_name)
+                self._push(chat_id, next_reset(reset_time, tz_name, now))
+
+    async def set_schedule(self, chat_id, reset_time, tz_name):
+        await run_db(save_reset_schedule, chat_id, reset_time, tz_name)
+        self.schedules[chat_id] = (reset_time, tz_name)
+        self._push(chat_id, next_reset(reset_time, tz_name, datetime.now(timezone.utc)))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            await self.load()
+        except Exception as e:
+            print(f"❌ Помилка завантаження розкладу скидань: {e}")
+            self._push(DEFAULT_RESET_CHAT, next_reset(parse_reset_time(RESET_TIME), RESET_TIMEZONE, datetime.now(timezone.utc)))
+            self.schedules.setdefault(DEFAULT_RESET_CHAT, (parse_reset_time(RESET_TIME), RESET_TIMEZONE))
+        while True:
+            self._changed.clear()
+            if not self.heap:
+                await self._changed.wait()
+                continue
+            due, chat_id = self.heap[0]
+            delay = (due - datetime.now(timezone.utc)).total_seconds()
+            if delay > 0:
+                try:
+                    # Прокидаємось раніше, якщо розклад змінився
+                    await asyncio.wait_for(self._changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            if self.due.get(chat_id) != due:
+                continue  # розклад змінився, запис застарів
+            try:
+                await self.fire(chat_id, due)
+            except Exception as e:
+                print(f"❌ Помилка скидання статусів (чат {chat_id}): {e}")
+            reset_time, tz_name = self.schedules[chat_id]
+            self._push(chat_id, next_reset(reset_time, tz_name, max(due, datetime.now(timezone.utc))))
+
+    async def fire(self, chat_id, due):
+        if chat_id == DEFAULT_RESET_CHAT:
+            # Скидання за замовчуванням не чіпає чати з власним розкладом: список має бути свіжим
+            try:
+                await self.reload()
+            except Exception as e:
+                print(f"❌ Не вдалося оновити розклади скидань: {e}")
+        try:
+            claimed = await run_db(claim_reset, chat_id, due)
+        except Exception as e:
+            # БД недоступна: скидаємо в пам'яті, зміни дійдуть через відкладений запис
+            print(f"❌ Не вдалося зафіксувати скидання в БД: {e}")
+            claimed = None
+        if claimed is False and WORKER_COUNT == 1:
+            return
+        # Масовий UPDATE робить тільки процес, що зафіксував скидання; інші воркери
+        # скидають своїх користувачів у пам'яті і пишуть їх через відкладений запис
+        await reset_statuses(chat_id, set(self.schedules) - {DEFAULT_RESET_CHAT}, bulk_update=bool(claimed))
+        if chat_id == DEFAULT_RESET_CHAT and claimed:
+            # Раз на добу заодно створюємо партиції журналу на наступні місяці
+            try:
+                await run_db(ensure_event_partitions_in_db)
+            except Exception as e:
+                print(f"❌ Помилка створення партицій журналу: {e}")
+
+reset_scheduler = ResetScheduler()
+
+async def reset_statuses(chat_id, scheduled_chats, bulk_update=True):
+    """Скинути статуси користувачів чату (або всіх без власного розкладу для chat_id = 0)"""
+    def in_scope(status):
+        if chat_id:
+            return status.get('chat_id') == chat_id
+        return status.get('chat_id') not in scheduled_chats
+    # Поки журнал не перенесено, UPDATE по БД перезаписали б пізніші пачки з журналу
+    bulk_update = bulk_update and not status_writer.journaled and not db_pool.breaker.is_open
+    # Проходимо тільки по активних: оновлюємо пам'ять; для своїх користувачів ще журнал і чергу запису
+    affected = [user_id for user_id in roster.active_ids() if in_scope(user_status[user_id])]
+    for user_id in affected:
+        status = user_status[user_id]
+        status['active'] = False
+        roster.update(user_id, status)
+        if not owns_user(user_id):
+            continue
+        status_writer.log_event(user_id, status.get('chat_id'), 'reset', status.get('workload'))
+        if not bulk_update or user_id in status_writer.pending:
+            status_writer.enqueue(user_id, status)
+    if affected:
+        live_roster.mark_dirty()
+    if bulk_update:
+        # Один UPDATE ... WHERE active; під lock, щоб паралельний flush не перезаписав
+        async with status_writer.lock:
+            await run_db(reset_chat_statuses_in_db, chat_id)
+    print(f"🌙 Скинуто статуси (чат {chat_id or 'за замовчуванням'}): {len(affected)} осіб")
+
+# Нагадування і автоматичний check-out
+REMINDER_TIMEZONE = os.getenv('REMINDER_TIMEZONE', RESET_TIMEZONE)
+REMINDER_CHECKIN_TIME = os.getenv('REMINDER_CHECKIN_TIME', '')  # "10:00" - кому нагадати про check-in; порожньо - вимкнено
+REMINDER_CHECKOUT_TIME = os.getenv('REMINDER_CHECKOUT_TIME', '')  # "19:00" - кому нагадати про check-out
+REMINDER_WEEKDAYS = {int(day) for day in os.getenv('REMINDER_WEEKDAYS', '0,1,2,3,4').split(',') if day.strip()}  # 0 - понеділок
+REMINDER_LOOKBACK_DAYS = int(os.getenv('REMINDER_LOOKBACK_DAYS', 14))  # про check-in нагадуємо тим, хто відмічався за ці дні
+AUTO_CHECKOUT_HOURS = float(os.getenv('AUTO_CHECKOUT_HOURS', 0))  # 0 - автоматичний check-out вимкнено
+REMINDER_BATCH = int(os.getenv('REMINDER_BATCH', 100))  # користувачів на запит і пачку повідомлень
+REMINDER_GRACE = timedelta(hours=2)  # пропущене під час простою нагадування ще надсилається стільки часу
+REMINDER_RETRY = 60  # секунди: повтор при недоступній БД і крок перевірки автоматичного check-out
+AUTO_CHECKOUT_MAX_SLEEP = 600  # секунди між перевірками, навіть якщо до найближчого ще далеко
+CHECKIN_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+REMINDERS = Counter('bot_reminders_total', 'Нагадування і автоматичні check-out', ['kind', 'result'])
+
+REMINDER_TEXTS = {
+    'checkin': "⏰ Сьогодні ще немає check-in. /in - швидкий check-in",
+    'checkout': "⏰ Робочий день закінчився, а check-out ще немає. /out - швидкий check-out",
+    'auto': "🚪 Автоматичний check-out: на роботі понад {hours:g} год",
+}
 
-def run_http():
-    HTTPServer(('0.0.0.0', int(os.getenv('PORT', 10000))), SimpleHandler).serve_forever()
+class ReminderScheduler:
+    """Щоденні нагадування (ще немає check-in / ще немає check-out) і автоматичний check-out.
 
-# Функції для роботи з базою даних
-def get_shared_media_from_db():
-    """Отримати СПІЛЬНУ бібліотеку медіа з БД"""
-    conn = get_db_connection()
-    if not conn:
-        return {'checkin': [], 'checkout': []}
-    try:
-        cur = conn.cursor()
-        cur.execute('SELECT checkin_media, checkout_media FROM shared_media WHERE media_type = %s', ('shared',))
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
-        if result:
-            return {'checkin': result[0] or [], 'checkout': result[1] or []}
-        return {'checkin': [], 'checkout': []}
-    except Exception as e:
-        print(f"❌ Помилка читання медіа: {e}")
-        if conn:
-            conn.close()
-        return {'checkin': [], 'checkout': []}
-
-def save_shared_media_to_db(media):
-    """Зберегти СПІЛЬНУ бібліотеку медіа в БД"""
-    conn = get_db_connection()
-    if not conn:
-        return
-    try:
-        cur = conn.cursor()
-        cur.execute('''
-            UPDATE shared_media 
-            SET checkin_media = %s, checkout_media = %s
-            WHERE media_type = %s
-        ''', (Json(media['checkin']), Json(media['checkout']), 'shared'))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        print(f"❌ Помилка збереження медіа: {e}")
-        if conn:
-            conn.close()
+    Кому нагадувати, вибирає запит діапазоном по індексу checked_in_at, пачками по REMINDER_BATCH.
+    Кожна пачка спершу фіксується в reminder_log, тож ні інший процес, ні перезапуск не надішлють
+    вдруге. Повідомлення йдуть через outbound, тобто в межах лімітів Telegram.
+    """
+    def __init__(self):
+        self.bot = None
+        self._tasks = []
 
-def get_user_status_from_db(user_id):
-    """Отримати статус користувача з БД"""
-    conn = get_db_connection()
-    if not conn:
-        return None
-    try:
-        cur = conn.cursor()
-        cur.execute('SELECT active, username, workload FROM user_status WHERE user_id = %s', (user_id,))
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
-        if result:
-            return {'active': result[0], 'username': result[1], 'workload': result[2]}
-        return None
-    except Exception as e:
-        print(f"❌ Помилка читання статусу: {e}")
-        if conn:
-            conn.close()
-        return None
+    def start(self, bot):
+        self.bot = bot
+        for kind, value in (('checkin', REMINDER_CHECKIN_TIME), ('checkout', REMINDER_CHECKOUT_TIME)):
+            if value:
+                self._tasks.append(asyncio.create_task(self._daily(kind, parse_reset_time(value))))
+        if AUTO_CHECKOUT_HOURS > 0:
+            self._tasks.append(asyncio.create_task(self._auto_checkout()))
 
-def save_user_status_to_db(user_id, status):
-    """Зберегти статус користувача в БД"""
-    conn = get_db_connection()
-    if not conn:
-        return
-    try:
-        cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO user_status (user_id, active, username, workload)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET active = %s, username = %s, workload = %s
-        ''', (user_id, status['active'], status['username'], status.get('workload'),
-              status['active'], status['username'], status.get('workload')))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        print(f"❌ Помилка збереження статусу: {e}")
-        if conn:
-            conn.close()
+    async def _daily(self, kind, at):
+        now = datetime.now(timezone.utc)
+        due = previous_reset(at, REMINDER_TIMEZONE, now)
+        if now - due > REMINDER_GRACE:
+            due = next_reset(at, REMINDER_TIMEZONE, now)
+        while True:
+            delay = (due - datetime.now(timezone.utc)).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if due.astimezone(ZoneInfo(REMINDER_TIMEZONE)).weekday() in REMINDER_WEEKDAYS:
+                try:
+                    await self.remind(kind, due)
+                except Exception as e:
+                    print(f"❌ Помилка нагадувань ({kind}): {e}")
+                    if datetime.now(timezone.utc) - due < REMINDER_GRACE:
+                        # Надіслані вже зафіксовані: повтор дійде тільки до решти
+                        await asyncio.sleep(REMINDER_RETRY)
+                        continue
+            due = next_reset(at, REMINDER_TIMEZONE, max(due, datetime.now(timezone.utc)))
 
-def get_all_user_statuses():
-    """Отримати всі статуси користувачів"""
-    conn = get_db_connection()
-    if not conn:
-        return {}
-    try:
-        cur = conn.cursor()
-        cur.execute('SELECT user_id, active, username, workload FROM user_status')
-        results = cur.fetchall()
-        cur.close()
-        conn.close()
-        statuses = {}
-        for row in results:
-            statuses[row[0]] = {'active': row[1], 'username': row[2], 'workload': row[3]}
-        return statuses
-    except Exception as e:
-        print(f"❌ Помилка читання всіх статусів: {e}")
-        if conn:
-            conn.close()
-        return {}
+    async def _due_batches(self, active, since, until):
+        after_user = 0
+        while True:
+            rows = await run_db(get_due_users, active, since, until, after_user, REMINDER_BATCH)
+            if rows:
+                yield rows
+            if len(rows) < REMINDER_BATCH:
+                return
+            after_user, since = rows[-1]
 
-user_status = {}
-shared_media = {'checkin': [], 'checkout': []}  # Спільна бібліотека для всіх
-WORKLOAD = {'🟢': 'Потрібні задачі', '🟡': 'Середня завантаженість', '🔴': 'Завантаженість до пенсії'}
+    async def remind(self, kind, due):
+        if kind == 'checkin':
+            # Неактивні, чий останній check-in - до початку дня (але не давніше REMINDER_LOOKBACK_DAYS)
+            tz = ZoneInfo(REMINDER_TIMEZONE)
+            day_start = datetime.combine(due.astimezone(tz).date(), time(0), tzinfo=tz).astimezone(timezone.utc)
+            batches = self._due_batches(False, day_start - timedelta(days=REMINDER_LOOKBACK_DAYS), day_start)
+        else:
+            batches = self._due_batches(True, CHECKIN_EPOCH, due)
+        sent = 0
+        async for rows in batches:
+            # БД може відставати на ще не записану пачку: пам'ять новіша
+            users = [(user_id, due) for user_id, _ in rows
+                     if user_status.get(user_id, {}).get('active', False) == (kind == 'checkout')]
+            claimed = await run_db(claim_reminders, kind, users)
+            await asyncio.gather(*(self._notify(kind, user_id, REMINDER_TEXTS[kind]) for user_id in claimed))
+            sent += len(claimed)
+        print(f"⏰ Нагадування ({kind}): {sent} осіб")
 
-async def reset_all_statuses():
-    """Скинути всі статуси користувачів"""
-    global user_status
-    conn = get_db_connection()
-    if not conn:
-        return
-    try:
-        cur = conn.cursor()
-        # Скидаємо всі active статуси на FALSE
-        cur.execute('UPDATE user_status SET active = FALSE')
-        conn.commit()
-        cur.close()
-        conn.close()
-        # Оновлюємо в пам'яті
-        for user_id in user_status:
-            user_status[user_id]['active'] = False
-        print(f"🌙 Опівночі скинуто статуси всіх користувачів ({len(user_status)} осіб)")
-    except Exception as e:
-        print(f"❌ Помилка скидання статусів: {e}")
-        if conn:
-            conn.close()
+    async def _auto_checkout(self):
+        while True:
+            delay = AUTO_CHECKOUT_MAX_SLEEP
+            try:
+                oldest = await run_db(get_oldest_active_checkin)
+                if oldest is not None:
+                    now = datetime.now(timezone.utc)
+                    due = oldest + timedelta(hours=AUTO_CHECKOUT_HOURS)
+                    if due <= now:
+                        await self.auto_checkout(now - timedelta(hours=AUTO_CHECKOUT_HOURS))
+                        delay = REMINDER_RETRY
+                    else:
+                        delay = min(delay, (due - now).total_seconds())
+            except Exception as e:
+                print(f"❌ Помилка автоматичного check-out: {e}")
+                delay = REMINDER_RETRY
+            await asyncio.sleep(delay)
 
-async def schedule_midnight_reset(app):
-    """Щоденне скидання статусів о півночі"""
-    while True:
-        now = datetime.now()
-        # Розраховуємо час до наступної півночі
-        midnight = datetime.combine(now.date(), time(0, 0, 0))
-        if now.time() >= time(0, 0, 0):
-            # Якщо вже після півночі, беремо наступну добу
-            from datetime import timedelta
-            midnight = midnight + timedelta(days=1)
-        
-        seconds_until_midnight = (midnight - now).total_seconds()
-        print(f"⏰ Наступне скидання статусів через {seconds_until_midnight/3600:.1f} годин")
-        
-        # Чекаємо до півночі
-        await asyncio.sleep(seconds_until_midnight)
-        
-        # Скидаємо статуси
-        await reset_all_statuses()
-        
-        # Чекаємо 61 секунду щоб не запуститись двічі в одну хвилину
-        await asyncio.sleep(61)
+    async def auto_checkout(self, cutoff):
+        """Check-out усім, хто активний з check-in раніше cutoff; мітка в reminder_log - час check-in"""
+        done = 0
+        async for rows in self._due_batches(True, CHECKIN_EPOCH, cutoff):
+            rows = [(user_id, checked_in_at) for user_id, checked_in_at in rows
+                    if user_status.get(user_id, {}).get('active')]
+            claimed = await run_db(claim_reminders, 'auto', rows)
+            for user_id in claimed:
+                status = user_status.get(user_id)
+                if status and status['active']:
+                    # Звичайна відмітка: подія checkout закриває сесію в attendance_daily
+                    set_user_status(user_id, {**status, 'active': False}, status.get('chat_id'))
+            text = REMINDER_TEXTS['auto'].format(hours=AUTO_CHECKOUT_HOURS)
+            await asyncio.gather(*(self._notify('auto', user_id, text) for user_id in claimed))
+            done += len(claimed)
+        if done:
+            print(f"🚪 Автоматичний check-out: {done} осіб")
+
+    async def _notify(self, kind, user_id, text):
+        try:
+            await outbound.call(PRIORITY_ANNOUNCE, user_id, self.bot.send_message, user_id, text)
+            REMINDERS.inc(kind=kind, result='sent')
+        except TelegramError as e:
+            # Найчастіше Forbidden: користувач не відкривав приватний чат з ботом
+            REMINDERS.inc(kind=kind, result='failed')
+            print(f"❌ Нагадування {user_id} не доставлено: {e}")
+
+reminders = ReminderScheduler()
 
-def get_media(user_id=None):
+# Маршрутизація кнопок: callback_data = версія + код маршруту + поля через ":"
+CALLBACK_VERSION = '1'  # змінити при несумісній зміні кодів або полів: старі кнопки стануть застарілими
+CALLBACK_DATA_LIMIT = 64  # байтів, ліміт Telegram
+
+CALLBACK_SECONDS = Histogram('bot_callback_seconds', 'Час обробки кнопок по маршрутах', ['route'])
+CALLBACK_ERRORS = Counter('bot_callback_errors_total', 'Помилки кнопок: invalid - нерозібраний callback_data, exception - виняток', ['route', 'reason'])
+
+class CallbackDataError(ValueError):
+    """callback_data не розбирається: інша версія, невідомий код або зіпсовані поля"""
+
+class CallbackField:
+    """Тип поля callback_data: як закодувати значення в рядок і назад"""
+    def __init__(self, encode, decode):
+        self.encode = encode
+        self.decode = decode
+
+def enum_field(*values):
+    """Поле з фіксованого набору: кодується індексом"""
+    def decode(text):
+        index = int(text)
+        if not 0 <= index < len(values):
+            raise CallbackDataError(f'немає значення #{text}')
+        return values[index]
+    return CallbackField(lambda value: str(values.index(value)), decode)
+
+INT_FIELD = CallbackField(lambda value: format(value, 'x'), lambda text: int(text, 16))
+
+class CallbackRoute:
+    __slots__ = ('name', 'code', 'handler', 'fields')
+
+    def __init__(self, name, code, handler, fields):
+        self.name = name
+        self.code = code
+        self.handler = handler
+        self.fields = fields  # ((назва аргументу, CallbackField), ...)
+
+class CallbackRouter:
+    """Кнопки -> хендлери: маршрут знаходиться за кодом у dict, поля передаються іменованими аргументами"""
+    def __init__(self, version):
+        self.version = version
+        self.by_code = {}
+        self.by_name = {}
+
+    def add(self, name, code, handler, **fields):
+        if code in self.by_code or ':' in code:
+            raise ValueError(f'код маршруту {code!r} зайнятий або некоректний')
+        route = CallbackRoute(name, code, handler, tuple(fields.items()))
+        self.by_code[code] = self.by_name[name] = route
+
+    def encode(self, name, **values):
+        route = self.by_name[name]
+        data = ':'.join([self.version + route.code, *(field.encode(values[arg]) for arg, field in route.fields)])
+        if len(data.encode()) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f'callback_data довше {CALLBACK_DATA_LIMIT} байт: {data!r}')
+        return data
+
+    def decode(self, data):
+        if not data or not data.startswith(self.version):
+            raise CallbackDataError(f'інша версія: {data!r}')
+        code, *parts = data[len(self.version):].split(':')
+        route = self.by_code.get(code)
+        if route is None or len(parts) != len(route.fields):
+            raise CallbackDataError(f'невідомий маршрут: {data!r}')
+        try:
+            return route, {arg: field.decode(part) for (arg, field), part in zip(route.fields, parts)}
+        except (ValueError, IndexError) as e:
+            raise CallbackDataError(f'зіпсовані поля {data!r}: {e}') from e
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            route, values = self.decode(update.callback_query.data)
+        except CallbackDataError as e:
+            CALLBACK_ERRORS.inc(route='', reason='invalid')
+            print(f"⚠️ Застаріла кнопка: {e}")
+            await answer(update, "❌ Кнопка застаріла, відкрий меню: /start", show_alert=True)
+            return
+        with CALLBACK_SECONDS.time(route=route.name):
+            try:
+                await route.handler(update, context, **values)
+            except Exception:
+                CALLBACK_ERRORS.inc(route=route.name, reason='exception')
+                raise
+
+callbacks = CallbackRouter(CALLBACK_VERSION)
+
+def callback_data(name, **values):
+    """callback_data для кнопки маршруту name"""
+    return callbacks.encode(name, **values)
+
+def main_menu_markup():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Check-in", callback_data=callback_data('checkin'))],
+        [InlineKeyboardButton("🚪 Check-out", callback_data=callback_data('checkout'))],
+        # Одним натиском: запам'ятована завантаженість і медіа з бібліотеки, меню залишається
+        [InlineKeyboardButton("⚡ Check-in", callback_data=callback_data('quick_checkin')),
+         InlineKeyboardButton("⚡ Check-out", callback_data=callback_data('quick_checkout'))],
+        [InlineKeyboardButton("👥 Команда", callback_data=callback_data('team'))],
+        [InlineKeyboardButton("🎨 Налаштування", callback_data=callback_data('settings'))],
+    ])
+
+# Версія бібліотеки: змінюється при кожній мутації і інвалідує кеш клавіатур
+library_version = 0
+# Версія бібліотеки в БД, до якої підтягнуто пам'ять; None - ще не завантажена
+library_db_version = None
+_keyboard_cache = {'version': -1, 'views': {}}
+media_by_id = {}  # id -> (kind, елемент) для O(1) пошуку з callback_data
+# Мутації бібліотеки (додавання, видалення, перезавантаження з БД) по одній: між ними є await на БД.
+# Читачам lock не потрібен: між await бібліотека в пам'яті завжди цілісна
+library_lock = asyncio.Lock()
+LIBRARY_PAGE_SIZE = int(os.getenv('LIBRARY_PAGE_SIZE', 8))
+MEDIA_EMOJI = {'text': '💬', 'photo': '🖼', 'animation': '🎬', 'video': '🎥'}
+# (kind, дія) -> маршрут кнопки елемента; у callback_data передається стабільний id елемента
+LIBRARY_CALLBACKS = {
+    ('checkin', 'select'): 'checkin_item',
+    ('checkout', 'select'): 'checkout_item',
+    ('checkin', 'delete'): 'delete_checkin_item',
+    ('checkout', 'delete'): 'delete_checkout_item',
+}
+# Куди (маршрут) веде "Назад" з кожного виду бібліотеки
+LIBRARY_BACK = {'select': 'back', 'delete': 'settings'}
+
+def bump_library_version():
+    global library_version
+    library_version += 1
+
+def set_library(media, version):
+    """Замінити бібліотеку в пам'яті цілком (завантаження з БД)"""
+    global shared_media, library_db_version
+    shared_media = media
+    library_db_version = version
+    media_by_id.clear()
+    for kind, items in media.items():
+        for item in items:
+            media_by_id[item['id']] = (kind, item)
+    search_index.rebuild(media)
+    bump_library_version()
+
+def apply_library_changes(version, changes):
+    """Застосувати зміни з БД до пам'яті: тільки змінені елементи, оновлений лишається на своєму місці"""
+    global library_db_version
+    changed = False
+    for item_id, kind, item in changes:
+        current = media_by_id.get(item_id)
+        if current == (kind, item):
+            # Власна зміна цього процесу: в пам'яті вже є
+            continue
+        if current is not None:
+            items = shared_media[current[0]]
+            idx = items.index(current[1])
+            if current[0] == kind:
+                items[idx] = item
+            else:
+                items.pop(idx)
+            del media_by_id[item_id]
+            search_index.remove(item_id)
+        if item is not None:
+            if current is None or current[0] != kind:
+                shared_media[kind].append(item)
+            media_by_id[item_id] = (kind, item)
+            search_index.add(kind, item)
+        changed = changed or current is not None or item is not None
+    library_db_version = max(library_db_version, version)
+    if changed:
+        bump_library_version()
+    return changed
+
+class MediaSearchIndex:
+    """Пошук по назвах і тексту бібліотеки: триграми -> id елементів.
+
+    Змінюється точково при додаванні/видаленні елемента і цілком при set_library.
+    Запит з 3+ символів - перетин найкоротших списків триграм і перевірка підрядка;
+    коротший - перебір рядків у пам'яті (для тисяч елементів це теж частки мілісекунди).
+    """
+    def __init__(self):
+        self.items = {}  # id -> (kind, елемент, нормалізований текст)
+        self.grams = {}  # триграма -> {id}
+
+    @staticmethod
+    def _text(item):
+        return ' '.join(filter(None, (item.get('name'), item['content'] if item['type'] == 'text' else None))).casefold()
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, kind, item):
+        text = self._text(item)
+        self.items[item['id']] = (kind, item, text)
+        for gram in self._trigrams(text):
+            self.grams.setdefault(gram, set()).add(item['id'])
+
+    def remove(self, item_id):
+        entry = self.items.pop(item_id, None)
+        if entry is None:
+            return
+        for gram in self._trigrams(entry[2]):
+            ids = self.grams.get(gram)
+            if ids is not None:
+                ids.discard(item_id)
+                if not ids:
+                    del self.grams[gram]
+
+    def rebuild(self, media):
+        self.items.clear()
+        self.grams.clear()
+        for kind, items in media.items():
+            for item in items:
+                self.add(kind, item)
+
+    def search(self, query):
+        """[(kind, елемент)] у порядку додавання; порожній запит - уся бібліотека"""
+        query = ' '.join(query.casefold().split())
+        if len(query) < 3:
+            ids = [item_id for item_id, (_, _, text) in self.items.items() if query in text]
+        else:
+            postings = sorted((self.grams.get(gram, ()) for gram in self._trigrams(query)), key=len)
+            if not postings[0]:
+                return []
+            ids = sorted(item_id for item_id in set(postings[0]).intersection(*postings[1:])
+                         if query in self.items[item_id][2])
+        return [self.items[item_id][:2] for item_id in ids]
+
+search_index = MediaSearchIndex()
+
+def find_media_item(kind, item_id):
+    """Знайти елемент за id; None якщо його вже видалено або він з іншої бібліотеки"""
+    found = media_by_id.get(item_id)
+    if found is None or found[0] != kind:
+        return None
+    return found[1]
+
+def media_label(item, i):
+    """Підпис кнопки: текст або назва (інакше "Медіа #N"), обрізані до 30 символів"""
+    emoji = MEDIA_EMOJI.get(item['type'], '📄')
+    name = item['content'] if item['type'] == 'text' else (item.get('name', '') or f"Медіа #{i+1}")
+    display_name = name[:30] + '...' if len(name) > 30 else name
+    return f"{emoji} {display_name}"
+
+def library_page_count(kind):
+    return max(1, -(-len(shared_media[kind]) // LIBRARY_PAGE_SIZE))
+
+def library_keyboard(kind, action, page=0):
+    """Сторінка клавіатури бібліотеки; будується один раз на версію бібліотеки і береться з кешу"""
+    if _keyboard_cache['version'] != library_version:
+        _keyboard_cache['version'] = library_version
+        _keyboard_cache['views'] = {}
+    pages = library_page_count(kind)
+    page = min(max(page, 0), pages - 1)
+    key = (kind, action, page)
+    markup = _keyboard_cache['views'].get(key)
+    if markup is None:
+        route = LIBRARY_CALLBACKS[(kind, action)]
+        start = page * LIBRARY_PAGE_SIZE
+        keyboard = [[InlineKeyboardButton(media_label(item, i), callback_data=callback_data(route, item_id=item['id']))]
+                    for i, item in enumerate(shared_media[kind][start:start + LIBRARY_PAGE_SIZE], start)]
+        if pages > 1:
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("◀️", callback_data=callback_data('page', kind=kind, action=action, page=page - 1)))
+            nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=callback_data('noop')))
+            if page < pages - 1:
+                nav.append(InlineKeyboardButton("▶️", callback_data=callback_data('page', kind=kind, action=action, page=page + 1)))
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=callback_data(LIBRARY_BACK[action]))])
+        markup = InlineKeyboardMarkup(keyboard)
+        _keyboard_cache['views'][key] = markup
+    return markup
+
+async def get_media(user_id=None):
     """Отримати СПІЛЬНУ бібліотеку медіа (user_id не використовується, але залишаємо для сумісності)"""
-    global shared_media
-    if not shared_media['checkin'] and not shared_media['checkout']:
-        # Завантажуємо з БД, якщо ще не завантажено
-        shared_media = get_shared_media_from_db()
+    if library_db_version is None:
+        async with library_lock:
+            # Завантажуємо з БД, якщо ще не завантажено (і не завантажив паралельний запит);
+            # далі бібліотеку свіжою тримає library_listener
+            if library_db_version is None:
+                set_library(*await run_db(get_shared_media_from_db))
     return shared_media
 
+async def add_media_item(kind, item):
+    """Додати елемент у спільну бібліотеку: один INSERT + додавання в пам'ять"""
+    await get_media()
+    async with library_lock:
+        saved = await run_db(add_media_item_to_db, kind, item)
+        if saved is not None:
+            # shared_media, а не знімок до await: бібліотеку могли перезавантажити
+            shared_media[kind].append(saved)
+            media_by_id[saved['id']] = (kind, saved)
+            search_index.add(kind, saved)
+            bump_library_version()
+    return saved
+
+async def remove_media_item(kind, item_id):
+    """Видалити елемент зі спільної бібліотеки за id.
+
+    Повертає (позиція, елемент); None - елемента вже немає; False - БД не видалила, пам'ять не змінена.
+    """
+    await get_media()
+    async with library_lock:
+        item = find_media_item(kind, item_id)
+        if item is None:
+            return None
+        # Спершу БД: інакше при помилці елемент зник би тільки до наступного перезавантаження
+        if not await run_db(delete_media_item_from_db, item_id):
+            return False
+        idx = shared_media[kind].index(item)
+        shared_media[kind].pop(idx)
+        del media_by_id[item_id]
+        search_index.remove(item_id)
+        bump_library_version()
+    return idx, item
+
 async def delete_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Автоматично видаляти всі команди бота"""
-    try:
-        await update.message.delete()
-    except:
-        pass
+    delete_later(update.message)
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    keyboard = [[InlineKeyboardButton("✅ Check-in", callback_data='checkin')], [InlineKeyboardButton("🚪 Check-out", callback_data='checkout')], [InlineKeyboardButton("👥 Команда", callback_data='team')], [InlineKeyboardButton("🎨 Налаштування", callback_data='settings')]]
-    await context.bot.send_message(chat_id=chat_id, text='👋 Бот для відмітки часу', reply_markup=InlineKeyboardMarkup(keyboard))
+    await send(chat_id, context.bot.send_message, text='👋 Бот для відмітки часу', reply_markup=main_menu_markup())
 
+@timed_handler
 async def checkin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    media = get_media()  # Спільна бібліотека
+    media = await get_media()  # Спільна бібліотека
     
     if not media['checkin']:
-        await context.bot.send_message(chat_id=chat_id, text='📚 Бібліотека check-in порожня! Додай медіа через /start → 🎨 Налаштування')
+        await send(chat_id, context.bot.send_message, text='📚 Бібліотека check-in порожня! Додай медіа через /start → 🎨 Налаштування')
         return
-    keyboard = []
-    for i, item in enumerate(media['checkin']):  # Показуємо ВСІ медіа
-        emoji = {'text': '💬', 'photo': '🖼', 'animation': '🎬', 'video': '🎥'}.get(item['type'], '📄')
-        if item['type'] == 'text':
-            text = item['content'][:30] + '...' if len(item['content']) > 30 else item['content']
-            keyboard.append([InlineKeyboardButton(f"{emoji} {text}", callback_data=f'ci_{i}')])
-        else:
-            # Показуємо назву якщо є, інакше "Медіа #N"
-            name = item.get('name', '') or f"Медіа #{i+1}"
-            display_name = name[:30] + '...' if len(name) > 30 else name
-            keyboard.append([InlineKeyboardButton(f"{emoji} {display_name}", callback_data=f'ci_{i}')])
-    await context.bot.send_message(chat_id=chat_id, text='📚 Обери Check-in:', reply_markup=InlineKeyboardMarkup(keyboard))
+    await send(chat_id, context.bot.send_message, text='📚 Обери Check-in:', reply_markup=library_keyboard('checkin', 'select'))
 
+@timed_handler
 async def checkout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    media = get_media()  # Спільна бібліотека
+    media = await get_media()  # Спільна бібліотека
     
     if not media['checkout']:
-        await context.bot.send_message(chat_id=chat_id, text='📚 Бібліотека check-out порожня! Додай медіа через /start → 🎨 Налаштування')
+        await send(chat_id, context.bot.send_message, text='📚 Бібліотека check-out порожня! Додай медіа через /start → 🎨 Налаштування')
         return
-    keyboard = []
-    for i, item in enumerate(media['checkout']):  # Показуємо ВСІ медіа
-        emoji = {'text': '💬', 'photo': '🖼', 'animation': '🎬', 'video': '🎥'}.get(item['type'], '📄')
-        if item['type'] == 'text':
-            text = item['content'][:30] + '...' if len(item['content']) > 30 else item['content']
-            keyboard.append([InlineKeyboardButton(f"{emoji} {text}", callback_data=f'co_{i}')])
-        else:
-            # Показуємо назву якщо є, інакше "Медіа #N"
-            name = item.get('name', '') or f"Медіа #{i+1}"
-            display_name = name[:30] + '...' if len(name) > 30 else name
-            keyboard.append([InlineKeyboardButton(f"{emoji} {display_name}", callback_data=f'co_{i}')])
-    await context.bot.send_message(chat_id=chat_id, text='📚 Обери Check-out:', reply_markup=InlineKeyboardMarkup(keyboard))
+    await send(chat_id, context.bot.send_message, text='📚 Обери Check-out:', reply_markup=library_keyboard('checkout', 'select'))
 
+@timed_handler
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    media = get_media()  # Спільна бібліотека
+    media = await get_media()  # Спільна бібліотека
     keyboard = [
-        [InlineKeyboardButton("➕ Додати Check-in", callback_data='add_checkin')], 
-        [InlineKeyboardButton("➕ Додати Check-out", callback_data='add_checkout')], 
-        [InlineKeyboardButton("📋 Бібліотека", callback_data='view_lib')], 
-        [InlineKeyboardButton("✏️ Редагувати Check-in", callback_data='edit_checkin')], 
-        [InlineKeyboardButton("✏️ Редагувати Check-out", callback_data='edit_checkout')], 
-        [InlineKeyboardButton("⬅️ Назад", callback_data='back')]
+        [InlineKeyboardButton("➕ Додати Check-in", callback_data=callback_data('add_checkin'))], 
+        [InlineKeyboardButton("➕ Додати Check-out", callback_data=callback_data('add_checkout'))], 
+        [InlineKeyboardButton("📋 Бібліотека", callback_data=callback_data('view_lib'))], 
+        [InlineKeyboardButton("✏️ Редагувати Check-in", callback_data=callback_data('edit_checkin'))], 
+        [InlineKeyboardButton("✏️ Редагувати Check-out", callback_data=callback_data('edit_checkout'))], 
+        [InlineKeyboardButton("⬅️ Назад", callback_data=callback_data('back'))]
     ]
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
+    await answer(update)
+    delete_later(update.callback_query.message)
     msg = f'🎨 Спільна бібліотека:\n\n✅ Check-in: {len(media["checkin"])}\n🚪 Check-out: {len(media["checkout"])}'
-    await context.bot.send_message(chat_id=chat_id, text=msg, reply_markup=InlineKeyboardMarkup(keyboard))
+    await send(chat_id, context.bot.send_message, text=msg, reply_markup=InlineKeyboardMarkup(keyboard))
 
+@timed_handler
 async def show_checkin_library(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    media = get_media()  # Спільна бібліотека
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
+    media = await get_media()  # Спільна бібліотека
+    await answer(update)
+    delete_later(update.callback_query.message)
     if not media['checkin']:
-        await context.bot.send_message(chat_id=chat_id, text='📚 Бібліотека порожня!')
+        await send(chat_id, context.bot.send_message, text='📚 Бібліотека порожня!')
         return
-    keyboard = []
-    for i, item in enumerate(media['checkin']):  # Показуємо ВСІ медіа
-        emoji = {'text': '💬', 'photo': '🖼', 'animation': '🎬', 'video': '🎥'}.get(item['type'], '📄')
-        if item['type'] == 'text':
-            text = item['content'][:30] + '...' if len(item['content']) > 30 else item['content']
-            keyboard.append([InlineKeyboardButton(f"{emoji} {text}", callback_data=f'ci_{i}')])
-        else:
-            # Показуємо назву якщо є, інакше "Медіа #N"
-            name = item.get('name', '') or f"Медіа #{i+1}"
-            display_name = name[:30] + '...' if len(name) > 30 else name
-            keyboard.append([InlineKeyboardButton(f"{emoji} {display_name}", callback_data=f'ci_{i}')])
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='checkin')])
-    await context.bot.send_message(chat_id=chat_id, text='📚 Обери Check-in:', reply_markup=InlineKeyboardMarkup(keyboard))
+    await send(chat_id, context.bot.send_message, text='📚 Обери Check-in:', reply_markup=library_keyboard('checkin', 'select'))
+
+@timed_handler
+async def show_checkout_library(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    media = await get_media()  # Спільна бібліотека
+    await answer(update)
+    delete_later(update.callback_query.message)
+    if not media['checkout']:
+        await send(chat_id, context.bot.send_message, text='📚 Бібліотека порожня!')
+        return
+    await send(chat_id, context.bot.send_message, text='📚 Обери Check-out:', reply_markup=library_keyboard('checkout', 'select'))
 
+@timed_handler
 async def edit_checkin_library(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показати Check-in медіа для редагування/видалення"""
     chat_id = update.effective_chat.id
-    media = get_media()
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
+    media = await get_media()
+    await answer(update)
+    delete_later(update.callback_query.message)
     
     if not media['checkin']:
-        await context.bot.send_message(chat_id=chat_id, text='📚 Бібліотека порожня!')
+        await send(chat_id, context.bot.send_message, text='📚 Бібліотека порожня!')
         return
     
-    keyboard = []
-    for i, item in enumerate(media['checkin']):
-        emoji = {'text': '💬', 'photo': '🖼', 'animation': '🎬', 'video': '🎥'}.get(item['type'], '📄')
-        if item['type'] == 'text':
-            text = item['content'][:30] + '...' if len(item['content']) > 30 else item['content']
-            keyboard.append([InlineKeyboardButton(f"{emoji} {text}", callback_data=f'delci_{i}')])
-        else:
-            name = item.get('name', '') or f"Медіа #{i+1}"
-            display_name = name[:30] + '...' if len(name) > 30 else name
-            keyboard.append([InlineKeyboardButton(f"{emoji} {display_name}", callback_data=f'delci_{i}')])
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='settings')])
-    await context.bot.send_message(chat_id=chat_id, text='🗑 Натисни на медіа щоб видалити:', reply_markup=InlineKeyboardMarkup(keyboard))
+    await send(chat_id, context.bot.send_message, text='🗑 Натисни на медіа щоб видалити:', reply_markup=library_keyboard('checkin', 'delete'))
 
+@timed_handler
 async def edit_checkout_library(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показати Check-out медіа для редагування/видалення"""
     chat_id = update.effective_chat.id
-    media = get_media()
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
+    media = await get_media()
+    await answer(update)
+    delete_later(update.callback_query.message)
     
     if not media['checkout']:
-        await context.bot.send_message(chat_id=chat_id, text='📚 Бібліотека порожня!')
+        await send(chat_id, context.bot.send_message, text='📚 Бібліотека порожня!')
         return
     
-    keyboard = []
-    for i, item in enumerate(media['checkout']):
-        emoji = {'text': '💬', 'photo': '🖼', 'animation': '🎬', 'video': '🎥'}.get(item['type'], '📄')
-        if item['type'] == 'text':
-            text = item['content'][:30] + '...' if len(item['content']) > 30 else item['content']
-            keyboard.append([InlineKeyboardButton(f"{emoji} {text}", callback_data=f'delco_{i}')])
-        else:
-            name = item.get('name', '') or f"Медіа #{i+1}"
-            display_name = name[:30] + '...' if len(name) > 30 else name
-            keyboard.append([InlineKeyboardButton(f"{emoji} {display_name}", callback_data=f'delco_{i}')])
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='settings')])
-    await context.bot.send_message(chat_id=chat_id, text='🗑 Натисни на медіа щоб видалити:', reply_markup=InlineKeyboardMarkup(keyboard))
+    await send(chat_id, context.bot.send_message, text='🗑 Натисни на медіа щоб видалити:', reply_markup=library_keyboard('checkout', 'delete'))
 
-async def delete_checkin_item(update: Update, context: ContextTypes.DEFAULT_TYPE, idx: int):
+@timed_handler
+async def delete_checkin_item(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id: int):
     """Видалити конкретний check-in елемент"""
-    media = get_media()
+    deleted = await remove_media_item('checkin', item_id)
     
-    if 0 <= idx < len(media['checkin']):
-        deleted_item = media['checkin'].pop(idx)
-        save_shared_media_to_db(media)
-        
+    if deleted:
+        idx, deleted_item = deleted
         # Показуємо що видалили
         if deleted_item['type'] == 'text':
             name = deleted_item['content'][:30]
         else:
             name = deleted_item.get('name', f"Медіа #{idx+1}")
         
-        await update.callback_query.answer(f"🗑 Видалено: {name}")
+        await answer(update, f"🗑 Видалено: {name}")
         
         # Оновлюємо список
         await edit_checkin_library(update, context)
+    elif deleted is False:
+        await answer(update, '❌ Не вдалося видалити, спробуй ще раз')
     else:
-        await update.callback_query.answer("❌ Помилка: елемент не знайдено")
+        await stale_library_button(update, context, 'checkin', 'delete')
 
-async def delete_checkout_item(update: Update, context: ContextTypes.DEFAULT_TYPE, idx: int):
+@timed_handler
+async def delete_checkout_item(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id: int):
     """Видалити конкретний check-out елемент"""
-    media = get_media()
+    deleted = await remove_media_item('checkout', item_id)
     
-    if 0 <= idx < len(media['checkout']):
-        deleted_item = media['checkout'].pop(idx)
-        save_shared_media_to_db(media)
-        
+    if deleted:
+        idx, deleted_item = deleted
         # Показуємо що видалили
         if deleted_item['type'] == 'text':
             name = deleted_item['content'][:30]
         else:
             name = deleted_item.get('name', f"Медіа #{idx+1}")
         
-        await update.callback_query.answer(f"🗑 Видалено: {name}")
+        await answer(update, f"🗑 Видалено: {name}")
         
         # Оновлюємо список
         await edit_checkout_library(update, context)
+    elif deleted is False:
+        await answer(update, '❌ Не вдалося видалити, спробуй ще раз')
     else:
-        await update.callback_query.answer("❌ Помилка: елемент не знайдено")
-    chat_id = update.effective_chat.id
-    media = get_media()  # Спільна бібліотека
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
-    if not media['checkout']:
-        await context.bot.send_message(chat_id=chat_id, text='📚 Бібліотека порожня!')
-        return
-    keyboard = []
-    for i, item in enumerate(media['checkout'][:10]):
-        emoji = {'text': '💬', 'photo': '🖼', 'animation': '🎬', 'video': '🎥'}.get(item['type'], '📄')
-        if item['type'] == 'text':
-            text = item['content'][:30] + '...' if len(item['content']) > 30 else item['content']
-            keyboard.append([InlineKeyboardButton(f"{emoji} {text}", callback_data=f'co_{i}')])
-        else:
-            # Показуємо назву якщо є, інакше "Медіа #N"
-            name = item.get('name', '') or f"Медіа #{i+1}"
-            display_name = name[:30] + '...' if len(name) > 30 else name
-            keyboard.append([InlineKeyboardButton(f"{emoji} {display_name}", callback_data=f'co_{i}')])
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='back')])
-    await context.bot.send_message(chat_id=chat_id, text='📚 Обери Check-out:', reply_markup=InlineKeyboardMarkup(keyboard))
+        await stale_library_button(update, context, 'checkout', 'delete')
+
+@timed_handler
+async def turn_library_page(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, action: str, page: int):
+    """Перегорнути сторінку бібліотеки в тому ж повідомленні"""
+    await get_media()
+    await answer(update)
+    try:
+        await outbound.call(PRIORITY_ANNOUNCE, update.effective_chat.id, update.callback_query.edit_message_reply_markup, reply_markup=library_keyboard(kind, action, page))
+    except Exception as e:
+        print(f"❌ Помилка перегортання сторінки: {e}")
+
+async def stale_library_button(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, action: str):
+    """Кнопка вказує на елемент, якого вже немає: попереджаємо і оновлюємо клавіатуру"""
+    await answer(update, "❌ Цього медіа вже немає, список оновлено", show_alert=True)
+    try:
+        await outbound.call(PRIORITY_ANNOUNCE, update.effective_chat.id, update.callback_query.edit_message_reply_markup, reply_markup=library_keyboard(kind, action))
+    except Exception as e:
+        print(f"❌ Помилка оновлення списку: {e}")
 
+@timed_handler
 async def show_workload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    keyboard = [[InlineKeyboardButton("🟢 Потрібні задачі", callback_data='w_🟢')], [InlineKeyboardButton("🟡 Середня завантаженість", callback_data='w_🟡')], [InlineKeyboardButton("🔴 Завантаженість до пенсії", callback_data='w_🔴')], [InlineKeyboardButton("➡️ Пропустити", callback_data='w_skip')]]
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
-    await context.bot.send_message(chat_id=chat_id, text='📊 Завантаженість:', reply_markup=InlineKeyboardMarkup(keyboard))
+    keyboard = [[InlineKeyboardButton(f"{emoji} {label}", callback_data=callback_data('workload', workload=emoji))] for emoji, label in WORKLOAD.items()]
+    keyboard.append([InlineKeyboardButton("➡️ Пропустити", callback_data=callback_data('workload', workload=None))])
+    await answer(update)
+    delete_later(update.callback_query.message)
+    await send(chat_id, context.bot.send_message, text='📊 Завантаженість:', reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def do_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE, media_idx: int, workload: str = None):
+@timed_handler
+async def do_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE, media_id: int, workload: str = None, keep_message: bool = False):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     username = update.effective_user.first_name
     if user_id in user_status and user_status[user_id]['active']:
-        await update.callback_query.answer("Вже на роботі!")
+        await acknowledge(update, "Вже на роботі!", error=True)
         return
-    user_status[user_id] = {'active': True, 'username': username, 'workload': workload}
-    save_user_status_to_db(user_id, user_status[user_id])  # Зберігаємо в БД
-    await update.callback_query.answer("✅ Check-in!")
+    set_user_status(user_id, {'active': True, 'username': username, 'workload': workload, 'chat_id': chat_id}, chat_id)  # В БД запишеться пачкою
+    await acknowledge(update, "✅ Check-in!")
     # ВИДАЛЯЄМО ПОВІДОМЛЕННЯ З ВИБОРОМ ЗАВАНТАЖЕНОСТІ
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
+    if update.callback_query and not keep_message:
+        delete_later(update.callback_query.message)
     msg = f"✅ {username} почав день!\n"
     if workload:
         msg += f"{workload} {WORKLOAD[workload]}\n"
     msg += "\n💪 Продуктивної роботи!"
-    media = get_media()  # Спільна бібліотека
-    if media['checkin']:
-        await send_media(context.bot, chat_id, media['checkin'][media_idx], msg)
+    await get_media()  # Спільна бібліотека
+    item = find_media_item('checkin', media_id)
+    if item:
+        await send_media(context.bot, chat_id, item, msg)
     else:
-        await context.bot.send_message(chat_id=chat_id, text=msg)
+        await send(chat_id, context.bot.send_message, text=msg)
 
-async def do_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE, media_idx: int):
+@timed_handler
+async def do_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE, media_id: int, keep_message: bool = False):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     username = update.effective_user.first_name
     if user_id not in user_status or not user_status[user_id]['active']:
-        await update.callback_query.answer("Спочатку check-in!")
+        await acknowledge(update, "Спочатку check-in!", error=True)
         return
-    user_status[user_id]['active'] = False
-    save_user_status_to_db(user_id, user_status[user_id])  # Зберігаємо в БД
-    await update.callback_query.answer("✅ Check-out!")
+    set_user_status(user_id, {**user_status[user_id], 'active': False}, chat_id)  # В БД запишеться пачкою
+    await acknowledge(update, "✅ Check-out!")
     # ВИДАЛЯЄМО ПОВІДОМЛЕННЯ З ВИБОРОМ МЕДІА
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
+    if update.callback_query and not keep_message:
+        delete_later(update.callback_query.message)
     msg = f"🚪 {username} закінчив день!\n\n👏 Чудова робота!"
-    media = get_media()  # Спільна бібліотека
-    if media['checkout']:
-        await send_media(context.bot, chat_id, media['checkout'][media_idx], msg)
+    await get_media()  # Спільна бібліотека
+    item = find_media_item('checkout', media_id)
+    if item:
+        await send_media(context.bot, chat_id, item, msg)
+    else:
+        await send(chat_id, context.bot.send_message, text=msg)
+
+# Швидка відмітка: /in [завантаженість], /out або кнопки ⚡ у меню - одне оновлення, одне повідомлення
+QUICK_MEDIA_PICK = os.getenv('QUICK_MEDIA_PICK', 'round_robin')  # round_robin | random
+
+class QuickMediaPicker:
+    """Медіа для швидкої відмітки: таблиця id по kind перебудовується раз на версію бібліотеки"""
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.version = None
+        self.table = {}
+        self.cursor = {}
+
+    def pick(self, kind):
+        if self.version != library_version:
+            self.table = {k: [item['id'] for item in items] for k, items in shared_media.items()}
+            self.version = library_version
+        ids = self.table.get(kind)
+        if not ids:
+            return None
+        if self.strategy == 'random':
+            return random.choice(ids)
+        i = self.cursor.get(kind, 0) % len(ids)
+        self.cursor[kind] = i + 1
+        return ids[i]
+
+quick_media = QuickMediaPicker(QUICK_MEDIA_PICK)
+
+@timed_handler
+async def quick_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Check-in без меню: завантаженість з аргументу /in або з минулого check-in"""
+    user_id = update.effective_user.id
+    if context.args and context.args[0] in WORKLOAD:
+        workload = context.args[0]
     else:
-        await context.bot.send_message(chat_id=chat_id, text=msg)
+        workload = user_status.get(user_id, {}).get('workload')
+    await get_media()
+    # __wrapped__ - без другого timed_handler: натиск рахується один раз, як quick_checkin
+    await do_checkin.__wrapped__(update, context, quick_media.pick('checkin'), workload, keep_message=True)
+
+@timed_handler
+async def quick_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await get_media()
+    await do_checkout.__wrapped__(update, context, quick_media.pick('checkout'), keep_message=True)
 
 async def send_media(bot, chat_id, item, text):
     try:
         t = item['type']
         c = item['content']
         if t == 'text':
-            await bot.send_message(chat_id=chat_id, text=f"{text}\n\n💬 {c}")
+            await send(chat_id, bot.send_message, text=f"{text}\n\n💬 {c}")
         elif t == 'photo':
-            await bot.send_photo(chat_id=chat_id, photo=c, caption=text)
+            await send(chat_id, bot.send_photo, photo=c, caption=text)
         elif t == 'animation':
-            await bot.send_animation(chat_id=chat_id, animation=c, caption=text)
+            await send(chat_id, bot.send_animation, animation=c, caption=text)
         elif t == 'video':
-            await bot.send_video(chat_id=chat_id, video=c, caption=text)
-    except:
-        await bot.send_message(chat_id=chat_id, text=text)
+            await send(chat_id, bot.send_video, video=c, caption=text)
+    except TelegramError as e:
+        # Наприклад, file_id більше не дійсний; RetryAfter вже оброблено в черзі
+        print(f"❌ Помилка відправки медіа: {e}")
+        await send(chat_id, bot.send_message, text=text)
+
+# Inline-режим: @bot запит -> медіа бібліотеки (inline mode вмикається в @BotFather)
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 30))  # секунди кешу відповіді на боці Telegram
+INLINE_PAGE_SIZE = 50  # ліміт результатів Telegram на одну відповідь
+INLINE_SEARCH_SECONDS = Histogram('bot_inline_search_seconds', 'Пошук по індексу бібліотеки',
+                                  buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
 
+# Кеш результатів по запиту в межах однієї версії бібліотеки
+_inline_cache = {'version': -1, 'queries': {}}
+
+def inline_results(query):
+    if _inline_cache['version'] != library_version:
+        _inline_cache['version'] = library_version
+        _inline_cache['queries'] = {}
+    queries = _inline_cache['queries']
+    found = queries.get(query)
+    if found is None:
+        with INLINE_SEARCH_SECONDS.time():
+            found = search_index.search(query)
+        if len(queries) >= 1000:
+            del queries[next(iter(queries))]
+        queries[query] = found
+    return found
+
+def inline_result(kind, item):
+    """Результат inline-запиту: медіа надсилається з file_id, текст - як повідомлення"""
+    result_id = str(item['id'])
+    title = f"{'✅' if kind == 'checkin' else '🚪'} {item.get('name') or MEDIA_EMOJI.get(item['type'], '📄')}"
+    if item['type'] == 'photo':
+        return InlineQueryResultCachedPhoto(result_id, item['content'], title=title)
+    if item['type'] == 'animation':
+        return InlineQueryResultCachedMpeg4Gif(result_id, item['content'], title=title)
+    if item['type'] == 'video':
+        return InlineQueryResultCachedVideo(result_id, item['content'], title)
+    return InlineQueryResultArticle(result_id, item['content'][:64], InputTextMessageContent(item['content']),
+                                    description='✅ Check-in' if kind == 'checkin' else '🚪 Check-out')
+
+@timed_handler
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    await get_media()
+    found = inline_results(query.query)
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    page = found[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(found) else ''
+    await outbound.call(PRIORITY_ANSWER, None, query.answer, [inline_result(kind, item) for kind, item in page],
+                        cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+
+@timed_handler
 async def team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    # Завантажуємо актуальні статуси з БД
-    all_statuses = get_all_user_statuses()
-    if not all_statuses:
-        msg = "📊 Немає даних"
-    else:
-        online = []
-        for d in all_statuses.values():
-            if d['active']:
-                if d.get('workload'):
-                    online.append(f"{d['workload']} {d['username']} - {WORKLOAD[d['workload']]}")
-                else:
-                    online.append(f"✅ {d['username']}")
-        offline = [f"⭕ {d['username']}" for d in all_statuses.values() if not d['active']]
-        msg = "👥 Команда:\n\n"
-        if online: msg += "🟢 На роботі:\n" + "\n".join(online) + "\n\n"
-        if offline: msg += "🔴 Не на роботі:\n" + "\n".join(offline)
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    # Список команди береться з індексу в пам'яті, без запиту до БД
+    if update.effective_chat.type == ChatType.PRIVATE:
+        await answer(update)
+        delete_later(update.callback_query.message)
+        # У приватному чаті список бачить одна людина: закріплювати і редагувати нема для кого
+        for text in roster.pages():
+            await send(chat_id, context.bot.send_message, text=text)
+        return
+    # Резерв до першого await: два одночасні натиски не надішлють два списки
+    if not live_roster.reserve(chat_id):
+        # Список уже закріплений (або саме надсилається) і оновлюється сам: нове повідомлення не потрібне
+        await answer(update, '📌 Список команди закріплено вгорі чату')
+        return
+    try:
+        await answer(update)
+        delete_later(update.callback_query.message)
+    finally:
+        # Навіть якщо відповідь на кнопку не вдалась: інакше резерв чату так і лишився б
+        await live_roster.create(chat_id)
+
+async def is_chat_admin(update):
+    """Чи автор оновлення - адміністратор або власник чату; помилка Telegram - ні"""
+    chat_id = update.effective_chat.id
+    sender_chat = update.effective_message.sender_chat
+    if sender_chat is not None:
+        # Анонімний адміністратор пише від імені самого чату
+        return sender_chat.id == chat_id
+    if update.effective_user is None:
+        return False
+    try:
+        # Не повідомлення в чат: ліміт чату на нього не діє, як і на відповіді на кнопки
+        member = await outbound.call(PRIORITY_ANSWER, chat_id, update.get_bot().get_chat_member, chat_id, update.effective_user.id)
+    except TelegramError as e:
+        print(f"❌ Не вдалося перевірити права в чаті {chat_id}: {e}")
+        return False
+    return member.status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+@timed_handler
+async def reset_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/resettime [ГГ:ХХ [Часовий/Пояс]] - показати або змінити час скидання статусів цього чату.
 
+    Подивитись може кожен, змінити в групі - тільки адміністратори.
+    """
+    chat_id = update.effective_chat.id
+    if not context.args:
+        reset_time, tz_name = reset_scheduler.schedules.get(chat_id) or reset_scheduler.schedules.get(
+            DEFAULT_RESET_CHAT, (parse_reset_time(RESET_TIME), RESET_TIMEZONE))
+        await send(chat_id, context.bot.send_message, text=f'⏰ Скидання статусів о {reset_time:%H:%M} ({tz_name})\n\nЗмінити: /resettime 23:30 Europe/Kyiv')
+        return
+    try:
+        reset_time = parse_reset_time(context.args[0])
+        tz_name = context.args[1] if len(context.args) > 1 else reset_scheduler.schedules.get(chat_id, (None, RESET_TIMEZONE))[1]
+        ZoneInfo(tz_name)
+    except Exception:
+        await send(chat_id, context.bot.send_message, text='❌ Формат: /resettime 23:30 Europe/Kyiv')
+        return
+    if update.effective_chat.type != ChatType.PRIVATE and not await is_chat_admin(update):
+        await send(chat_id, context.bot.send_message, text='❌ Змінити час скидання можуть тільки адміністратори чату')
+        return
+    try:
+        await reset_scheduler.set_schedule(chat_id, reset_time, tz_name)
+    except Exception as e:
+        print(f"❌ Помилка збереження розкладу: {e}")
+        await send(chat_id, context.bot.send_message, text='❌ Не вдалося зберегти, спробуй пізніше')
+        return
+    await send(chat_id, context.bot.send_message, text=f'✅ Статуси цього чату скидатимуться о {reset_time:%H:%M} ({tz_name})')
+
+REPORT_MAX_DAYS = 366
+WEEKDAYS = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'нд')
+
+def format_hours(seconds):
+    return f"{seconds / 3600:.1f}"
+
+@timed_handler
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/report [днів] - відпрацьовані години за останні N днів (за замовчуванням 7)"""
+    chat_id = update.effective_chat.id
+    try:
+        days = int(context.args[0]) if context.args else 7
+    except ValueError:
+        days = 7
+    days = min(max(days, 1), REPORT_MAX_DAYS)
+    since = datetime.now(ZoneInfo(REPORT_TIMEZONE)).date() - timedelta(days=days - 1)
+    rows = await run_db(get_attendance_report, since)
+    if rows is None:
+        await send(chat_id, context.bot.send_message, text='❌ Не вдалося отримати звіт, спробуй пізніше')
+        return
+    if not rows:
+        await send(chat_id, context.bot.send_message, text=f'📊 Немає закритих сесій за {days} дн.')
+        return
+    # Рядки вже відсортовані за іменем і днем: групуємо одним проходом
+    users = {}
+    for user_id, username, day, seconds in rows:
+        users.setdefault(user_id, (username, []))[1].append((day, seconds))
+    msg = f"📊 Відпрацьовано за {days} дн. (з {since:%d.%m}):\n"
+    for username, user_days in users.values():
+        total = sum(seconds for _, seconds in user_days)
+        msg += f"\n👤 {username}: {format_hours(total)} год"
+        if days <= 7:
+            msg += "\n   " + ", ".join(f"{WEEKDAYS[day.weekday()]} {day:%d.%m} {format_hours(seconds)}" for day, seconds in user_days)
+    await send(chat_id, context.bot.send_message, text=msg[:4096])
+
+@timed_handler
 async def start_add_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
-    await context.bot.send_message(chat_id=chat_id, text='📸 Надішли медіа:\n• 💬 Текст\n• 🖼 Фото\n• 🎬 Гіфку\n• 🎥 Відео\n\nПісля медіа система попросить назву.\n\n/done - готово, /cancel - скасувати')
+    await answer(update)
+    delete_later(update.callback_query.message)
+    await send(chat_id, context.bot.send_message, text='📸 Надішли медіа:\n• 💬 Текст\n• 🖼 Фото\n• 🎬 Гіфку\n• 🎥 Відео\n\nПісля медіа система попросить назву.\n\n/done - готово, /cancel - скасувати')
     return ADDING_CHECKIN_MEDIA
 
+@timed_handler
 async def start_add_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    await update.callback_query.answer()
-    try: 
-        await update.callback_query.message.delete()
-    except: 
-        pass
-    await context.bot.send_message(chat_id=chat_id, text='📸 Надішли медіа:\n• 💬 Текст\n• 🖼 Фото\n• 🎬 Гіфку\n• 🎥 Відео\n\nПісля медіа система попросить назву.\n\n/done - готово, /cancel - скасувати')
+    await answer(update)
+    delete_later(update.callback_query.message)
+    await send(chat_id, context.bot.send_message, text='📸 Надішли медіа:\n• 💬 Текст\n• 🖼 Фото\n• 🎬 Гіфку\n• 🎥 Відео\n\nПісля медіа система попросить назву.\n\n/done - готово, /cancel - скасувати')
     return ADDING_CHECKOUT_MEDIA
 
+@timed_handler
 async def receive_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text:
         # Текст додаємо відразу
-        media = get_media()
-        media['checkin'].append({'type': 'text', 'content': update.message.text, 'name': ''})
-        save_shared_media_to_db(media)
-        await update.message.reply_text(f'✅ Додано! Всього: {len(media["checkin"])}')
+        if not await add_media_item('checkin', {'type': 'text', 'content': update.message.text, 'name': ''}):
+            await reply(update, '❌ Не вдалося зберегти, спробуй ще раз')
+            return ADDING_CHECKIN_MEDIA
+        await reply(update, f'✅ Додано! Всього: {len(shared_media["checkin"])}')
         return ADDING_CHECKIN_MEDIA
     elif update.message.photo:
         # Зберігаємо фото тимчасово і просимо назву
         context.user_data['temp_media'] = {'type': 'photo', 'content': update.message.photo[-1].file_id}
-        await update.message.reply_text('📝 Надішли назву для цього фото (або /skip щоб пропустити):')
+        await reply(update, '📝 Надішли назву для цього фото (або /skip щоб пропустити):')
         return NAMING_CHECKIN_MEDIA
     elif update.message.animation:
         # Зберігаємо гіфку тимчасово і просимо назву
         context.user_data['temp_media'] = {'type': 'animation', 'content': update.message.animation.file_id}
-        await update.message.reply_text('📝 Надішли назву для цієї гіфки (або /skip щоб пропустити):')
+        await reply(update, '📝 Надішли назву для цієї гіфки (або /skip щоб пропустити):')
         return NAMING_CHECKIN_MEDIA
     elif update.message.video:
         # Зберігаємо відео тимчасово і просимо назву
         context.user_data['temp_media'] = {'type': 'video', 'content': update.message.video.file_id}
-        await update.message.reply_text('📝 Надішли назву для цього відео (або /skip щоб пропустити):')
+        await reply(update, '📝 Надішли назву для цього відео (або /skip щоб пропустити):')
         return NAMING_CHECKIN_MEDIA
     return ADDING_CHECKIN_MEDIA
 
+@timed_handler
 async def name_checkin_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Зберегти назву для check-in медіа"""
-    media = get_media()
     temp_media = context.user_data.get('temp_media')
     
     if not temp_media:
-        await update.message.reply_text('❌ Помилка: медіа не знайдено')
+        await reply(update, '❌ Помилка: медіа не знайдено')
         return ADDING_CHECKIN_MEDIA
     
     # Отримуємо назву або залишаємо порожньою
@@ -605,51 +3475,53 @@ async def name_checkin_media(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Додаємо медіа з назвою
     temp_media['name'] = name
-    media['checkin'].append(temp_media)
-    save_shared_media_to_db(media)
+    if not await add_media_item('checkin', temp_media):
+        await reply(update, '❌ Не вдалося зберегти, надішли назву ще раз')
+        return NAMING_CHECKIN_MEDIA
     
     # Очищаємо тимчасові дані
     context.user_data.pop('temp_media', None)
     
     if name:
-        await update.message.reply_text(f'✅ Додано "{name}"! Всього: {len(media["checkin"])}')
+        await reply(update, f'✅ Додано "{name}"! Всього: {len(shared_media["checkin"])}')
     else:
-        await update.message.reply_text(f'✅ Додано! Всього: {len(media["checkin"])}')
+        await reply(update, f'✅ Додано! Всього: {len(shared_media["checkin"])}')
     
     return ADDING_CHECKIN_MEDIA
 
+@timed_handler
 async def receive_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text:
         # Текст додаємо відразу
-        media = get_media()
-        media['checkout'].append({'type': 'text', 'content': update.message.text, 'name': ''})
-        save_shared_media_to_db(media)
-        await update.message.reply_text(f'✅ Додано! Всього: {len(media["checkout"])}')
+        if not await add_media_item('checkout', {'type': 'text', 'content': update.message.text, 'name': ''}):
+            await reply(update, '❌ Не вдалося зберегти, спробуй ще раз')
+            return ADDING_CHECKOUT_MEDIA
+        await reply(update, f'✅ Додано! Всього: {len(shared_media["checkout"])}')
         return ADDING_CHECKOUT_MEDIA
     elif update.message.photo:
         # Зберігаємо фото тимчасово і просимо назву
         context.user_data['temp_media'] = {'type': 'photo', 'content': update.message.photo[-1].file_id}
-        await update.message.reply_text('📝 Надішли назву для цього фото (або /skip щоб пропустити):')
+        await reply(update, '📝 Надішли назву для цього фото (або /skip щоб пропустити):')
         return NAMING_CHECKOUT_MEDIA
     elif update.message.animation:
         # Зберігаємо гіфку тимчасово і просимо назву
         context.user_data['temp_media'] = {'type': 'animation', 'content': update.message.animation.file_id}
-        await update.message.reply_text('📝 Надішли назву для цієї гіфки (або /skip щоб пропустити):')
+        await reply(update, '📝 Надішли назву для цієї гіфки (або /skip щоб пропустити):')
         return NAMING_CHECKOUT_MEDIA
     elif update.message.video:
         # Зберігаємо відео тимчасово і просимо назву
         context.user_data['temp_media'] = {'type': 'video', 'content': update.message.video.file_id}
-        await update.message.reply_text('📝 Надішли назву для цього відео (або /skip щоб пропустити):')
+        await reply(update, '📝 Надішли назву для цього відео (або /skip щоб пропустити):')
         return NAMING_CHECKOUT_MEDIA
     return ADDING_CHECKOUT_MEDIA
 
+@timed_handler
 async def name_checkout_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Зберегти назву для check-out медіа"""
-    media = get_media()
     temp_media = context.user_data.get('temp_media')
     
     if not temp_media:
-        await update.message.reply_text('❌ Помилка: медіа не знайдено')
+        await reply(update, '❌ Помилка: медіа не знайдено')
         return ADDING_CHECKOUT_MEDIA
     
     # Отримуємо назву або залишаємо порожньою
@@ -657,117 +3529,459 @@ async def name_checkout_media(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Додаємо медіа з назвою
     temp_media['name'] = name
-    media['checkout'].append(temp_media)
-    save_shared_media_to_db(media)
+    if not await add_media_item('checkout', temp_media):
+        await reply(update, '❌ Не вдалося зберегти, надішли назву ще раз')
+        return NAMING_CHECKOUT_MEDIA
     
     # Очищаємо тимчасові дані
     context.user_data.pop('temp_media', None)
     
     if name:
-        await update.message.reply_text(f'✅ Додано "{name}"! Всього: {len(media["checkout"])}')
+        await reply(update, f'✅ Додано "{name}"! Всього: {len(shared_media["checkout"])}')
     else:
-        await update.message.reply_text(f'✅ Додано! Всього: {len(media["checkout"])}')
+        await reply(update, f'✅ Додано! Всього: {len(shared_media["checkout"])}')
     
     return ADDING_CHECKOUT_MEDIA
 
+@timed_handler
 async def done(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text('✅ Збережено!')
+    await reply(update, '✅ Збережено!')
     return ConversationHandler.END
 
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text('❌ Скасовано')
+    await reply(update, '❌ Скасовано')
     return ConversationHandler.END
 
-async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = update.callback_query.data
-    if data in ['add_checkin', 'add_checkout']:
+async def pick_checkin_item(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id: int):
+    if not find_media_item('checkin', item_id):
+        await stale_library_button(update, context, 'checkin', 'select')
         return
-    if data == 'checkin':
-        await show_checkin_library(update, context)
-    elif data.startswith('ci_'):
-        idx = int(data[3:])
-        context.user_data['ci_idx'] = idx
-        await show_workload(update, context)
-    elif data.startswith('w_'):
-        idx = context.user_data.get('ci_idx', 0)
-        workload = None if data == 'w_skip' else data[2:]
-        await do_checkin(update, context, idx, workload)
-    elif data == 'checkout':
-        await show_checkout_library(update, context)
-    elif data.startswith('co_'):
-        idx = int(data[3:])
-        await do_checkout(update, context, idx)
-    elif data == 'team':
-        await team(update, context)
-    elif data == 'settings':
-        await settings(update, context)
-    elif data == 'edit_checkin':
-        await edit_checkin_library(update, context)
-    elif data == 'edit_checkout':
-        await edit_checkout_library(update, context)
-    elif data.startswith('delci_'):
-        idx = int(data[6:])
-        await delete_checkin_item(update, context, idx)
-    elif data.startswith('delco_'):
-        idx = int(data[6:])
-        await delete_checkout_item(update, context, idx)
-    elif data == 'view_lib':
-        media = get_media()
-        msg = f'📚 Спільна бібліотека:\n\n✅ Check-in: {len(media["checkin"])}\n🚪 Check-out: {len(media["checkout"])}'
-        await update.callback_query.answer()
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
-    elif data == 'back':
-        chat_id = update.effective_chat.id
-        keyboard = [[InlineKeyboardButton("✅ Check-in", callback_data='checkin')], [InlineKeyboardButton("🚪 Check-out", callback_data='checkout')], [InlineKeyboardButton("👥 Команда", callback_data='team')], [InlineKeyboardButton("🎨 Налаштування", callback_data='settings')]]
-        await update.callback_query.answer()
-        try: 
-            await update.callback_query.message.delete()
-        except: 
-            pass
-        await context.bot.send_message(chat_id=chat_id, text='👋 Меню:', reply_markup=InlineKeyboardMarkup(keyboard))
+    context.user_data['ci_id'] = item_id
+    await show_workload(update, context)
 
-def main():
-    TOKEN = os.getenv('BOT_TOKEN')
-    if not TOKEN:
-        print("❌ BOT_TOKEN не знайдено!")
+async def pick_workload(update: Update, context: ContextTypes.DEFAULT_TYPE, workload: str):
+    # Вибір використано: порожній user_data не пишеться в БД і не читається при рестарті
+    item_id = context.user_data.pop('ci_id', None)
+    await do_checkin(update, context, item_id, workload)
+
+async def pick_checkout_item(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id: int):
+    if not find_media_item('checkout', item_id):
+        await stale_library_button(update, context, 'checkout', 'select')
         return
-    
-    # Ініціалізуємо базу даних
-    init_db()
-    
-    # Завантажуємо спільну бібліотеку медіа
-    global shared_media
-    shared_media = get_shared_media_from_db()
-    print(f"📚 Завантажено медіа: Check-in={len(shared_media['checkin'])}, Check-out={len(shared_media['checkout'])}")
-    
-    # Завантажуємо статуси в пам'ять для швидкого доступу
+    await do_checkout(update, context, item_id)
+
+async def ignore_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await answer(update)
+
+async def add_media_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки додавання обробляє діалог add_media; сюди потрапляють, лише коли він уже йде"""
+
+@timed_handler
+async def view_library(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    media = await get_media()
+    msg = f'📚 Спільна бібліотека:\n\n✅ Check-in: {len(media["checkin"])}\n🚪 Check-out: {len(media["checkout"])}'
+    await answer(update)
+    await send(update.effective_chat.id, context.bot.send_message, text=msg)
+
+@timed_handler
+async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await answer(update)
+    delete_later(update.callback_query.message)
+    await send(update.effective_chat.id, context.bot.send_message, text='👋 Меню:', reply_markup=main_menu_markup())
+
+# Маршрути кнопок: назва, код у callback_data, хендлер, поля
+callbacks.add('checkin', 'c', show_checkin_library)
+callbacks.add('checkin_item', 'i', pick_checkin_item, item_id=INT_FIELD)
+callbacks.add('workload', 'w', pick_workload, workload=enum_field(*WORKLOAD, None))
+callbacks.add('checkout', 'o', show_checkout_library)
+callbacks.add('checkout_item', 'j', pick_checkout_item, item_id=INT_FIELD)
+callbacks.add('page', 'p', turn_library_page, kind=enum_field('checkin', 'checkout'),
+              action=enum_field('select', 'delete'), page=INT_FIELD)
+callbacks.add('noop', 'n', ignore_button)
+callbacks.add('quick_checkin', 'qi', quick_checkin)
+callbacks.add('quick_checkout', 'qo', quick_checkout)
+callbacks.add('team', 't', team)
+callbacks.add('settings', 's', settings)
+callbacks.add('edit_checkin', 'ei', edit_checkin_library)
+callbacks.add('edit_checkout', 'eo', edit_checkout_library)
+callbacks.add('delete_checkin_item', 'di', delete_checkin_item, item_id=INT_FIELD)
+callbacks.add('delete_checkout_item', 'do', delete_checkout_item, item_id=INT_FIELD)
+callbacks.add('view_lib', 'v', view_library)
+callbacks.add('back', 'b', back_to_menu)
+callbacks.add('add_checkin', 'ai', add_media_button)
+callbacks.add('add_checkout', 'ao', add_media_button)
+
+BOT_COMMANDS = [
+    BotCommand("start", "🏠 Головне меню"),
+    BotCommand("checkin", "✅ Check-in"),
+    BotCommand("checkout", "🚪 Check-out"),
+    BotCommand("in", "⚡ Швидкий check-in (можна з 🟢/🟡/🔴)"),
+    BotCommand("out", "⚡ Швидкий check-out"),
+    BotCommand("report", "📊 Відпрацьовані години"),
+]
+
+def update_shard_key(data):
+    """Ключ шардування сирого оновлення: id користувача, інакше id чату"""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from')
+            if sender:
+                return sender['id']
+            chat = value.get('chat') or (value.get('message') or {}).get('chat')
+            if chat:
+                return chat['id']
+    return 0
+
+def shard_for(key, count):
+    # int % count стабільний між процесами (на відміну від hash() для str)
+    return key % count
+
+class ShardDispatcher:
+    """Розподіляє сирі оновлення по процесах-воркерах за update_shard_key.
+
+    Один користувач завжди потрапляє в один процес, а черга процесу FIFO, тому порядок оновлень
+    кожного користувача зберігається. target(index, count, queue, ready, *args) - точка входу воркера.
+    """
+    def __init__(self, count, target, args=()):
+        ctx = multiprocessing.get_context('spawn')
+        self.count = count
+        self.queues = [ctx.Queue() for _ in range(count)]
+        self.ready = [ctx.Event() for _ in range(count)]
+        self.processes = [
+            ctx.Process(target=target, args=(i, count, self.queues[i], self.ready[i], *args), name=f'bot-worker-{i}')
+            for i in range(count)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def all_ready(self):
+        return all(event.is_set() for event in self.ready)
+
+    def dispatch(self, data):
+        self.queues[shard_for(update_shard_key(data), self.count)].put(json.dumps(data))
+
+    def stop(self, timeout=30):
+        """Надіслати воркерам сигнал завершення і дочекатися їх"""
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+def consume_shard_queue(queue, loop, deliver):
+    """Потік воркера: читає сирі оновлення з міжпроцесної черги і передає в event loop по порядку"""
+    while True:
+        raw = queue.get()
+        loop.call_soon_threadsafe(deliver, raw)
+        if raw is None:
+            return
+
+def shard_worker_main(index, count, queue, ready, token):
+    """Точка входу процесу-воркера"""
+    global PROCESS_ROLE, WORKER_INDEX, WORKER_COUNT
+    # Завершенням керує процес-приймач через None у черзі
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    PROCESS_ROLE, WORKER_INDEX, WORKER_COUNT = 'worker', index, count
+    # Глобальний ліміт Telegram ділимо між воркерами
+    outbound.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE / count, OUTBOUND_GLOBAL_RATE / count)
+    start_warm_up()
+    app = build_application(token, with_updater=False)
+    asyncio.run(run_shard_worker(app, queue, ready))
+
+async def run_shard_worker(app, queue, ready):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+
+    def deliver(raw):
+        if raw is None:
+            stop.set()
+            return
+        app.update_queue.put_nowait(Update.de_json(json.loads(raw), app.bot))
+
+    await app.initialize()
+    try:
+        await app.post_init(app)
+        await app.start()
+        ready.set()
+        print(f"🤖 Воркер {WORKER_INDEX + 1}/{WORKER_COUNT} запущено")
+        Thread(target=consume_shard_queue, args=(queue, loop, deliver), daemon=True).start()
+        await stop.wait()
+    finally:
+        if app.running:
+            await app.stop()
+            await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+async def run_ingest(token, count):
+    """Процес-приймач: отримує оновлення (webhook або polling) і роздає їх воркерам"""
+    global PROCESS_ROLE, webhook_sink
+    PROCESS_ROLE = 'ingest'
+    dispatcher = ShardDispatcher(count, shard_worker_main, (token,))
+    dispatcher.start()
+    webhook_sink = dispatcher.dispatch
+    readiness['db'] = await run_db(db_pool.ping)
+    http_server = await start_http_server(None)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def watch_workers():
+        # Готові, коли кожен воркер прогрів свої кеші
+        while not readiness['caches']:
+            readiness['caches'] = dispatcher.all_ready()
+            await asyncio.sleep(0.5)
+
+    async def poll(bot):
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=25, allowed_updates=Update.ALL_TYPES)
+            except TelegramError as e:
+                print(f"❌ Помилка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                dispatcher.dispatch(update.to_dict())
+                offset = update.update_id + 1
+
+    tasks = [asyncio.create_task(watch_workers())]
+    bot = Bot(token, base_url=f'{BOT_API_URL}/bot', request=InstrumentedRequest(connection_pool_size=8))
+    try:
+        async with bot:
+            await bot.set_my_commands(BOT_COMMANDS)
+            if WEBHOOK_URL:
+                await bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True,
+                )
+            else:
+                await bot.delete_webhook(drop_pending_updates=True)
+                tasks.append(asyncio.create_task(poll(bot)))
+            print(f"🤖 Приймач запущено, воркерів: {count}")
+            await stop.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        http_server.close()
+        await loop.run_in_executor(None, dispatcher.stop)
+        db_pool.close()
+
+# Паралельна обробка оновлень; оновлення одного користувача - строго по черзі
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', 32))  # 1 - послідовно, як раніше
+
+# Слот PerUserUpdateProcessor, який тримає поточне оновлення: [процесор, задача оновлення, чи слот зайнятий]
+_update_slot = contextvars.ContextVar('update_slot', default=None)
+
+@asynccontextmanager
+async def update_slot_released():
+    """Віддати слот оновлення на час довгого очікування (ліміт чату) і забрати його назад"""
+    slot = _update_slot.get()
+    # Задачі, створені хендлером, успадковують контекст, але слот належить тільки задачі оновлення
+    if slot is None or slot[1] is not asyncio.current_task() or not slot[2]:
+        yield
+        return
+    processor = slot[0]
+    slot[2] = False
+    processor._semaphore.release()
+    try:
+        yield
+    finally:
+        await processor._semaphore.acquire()
+        # Якщо acquire скасували, слот не повернувся: _run не звільнить його вдруге
+        slot[2] = True
+
+def update_serial_key(update):
+    """Ключ черговості: користувач, інакше чат; None - без обмежень"""
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """До max_concurrent_updates оновлень одночасно, але по одному на користувача.
+
+    Хендлери читають і змінюють user_status і стан діалогу через await, тому два оновлення
+    одного користувача не можуть перемежовуватись; asyncio.Lock віддає чергу в порядку надходження.
+    Lock користувача береться до семафора PTB: оновлення, що чекають свого користувача, не займають
+    слотів, і швидкі натискання одного не зупиняють решту. Так само слот віддається, поки хендлер
+    чекає вихідний виклик у чат з вичерпаним лімітом (update_slot_released): один зайнятий груповий
+    чат не забирає всі слоти.
+    """
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # ключ -> [lock, скільки оновлень його тримають або чекають]
+
+    async def process_update(self, update, coroutine):
+        key = update_serial_key(update) if isinstance(update, Update) else None
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _run(self, coroutine):
+        """Виконати оновлення в слоті семафора (max_concurrent_updates), який хендлер може тимчасово віддати"""
+        slot = [self, asyncio.current_task(), True]
+        await self._semaphore.acquire()
+        token = _update_slot.set(slot)
+        try:
+            await coroutine
+        finally:
+            _update_slot.reset(token)
+            if slot[2]:
+                self._semaphore.release()
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def warm_up():
+    """Ініціалізувати БД і завантажити бібліотеку та статуси в пам'ять (паралельно, двома з'єднаннями)"""
     global user_status
-    user_status = get_all_user_statuses()
+    with startup_phase('db'):
+        readiness['db'] = db_pool.ping()
+    if readiness['db']:
+        with startup_phase('schema'):
+            init_db()
+
+        def load(phase, func):
+            with startup_phase(phase):
+                return func()
+
+        with startup_phase('caches'):
+            media = db_executor.submit(load, 'media', get_shared_media_from_db)
+            statuses = db_executor.submit(load, 'statuses', get_all_user_statuses)
+            set_library(*media.result())
+            user_status = statuses.result()
+        readiness['caches'] = True
+    # Без БД не чекаємо таймаутів на кожному запиті: решту догрузить retry_warm_up
+    with startup_phase('journal'):
+        # Пачки, ще не перенесені з локального журналу, новіші за БД
+        user_status.update(status_writer.journal.pending_statuses())
+    roster.rebuild(user_status)
+    print(f"📚 Завантажено медіа: Check-in={len(shared_media['checkin'])}, Check-out={len(shared_media['checkout'])}")
     print(f"📊 Завантажено статусів: {len(user_status)}")
+
+# Фоновий warm_up: БД прогрівається, поки Application ініціалізується (getMe, HTTP-сервер)
+warm_up_future = None
+
+def start_warm_up():
+    global warm_up_future
+    warm_up_future = Future()
+
+    def run():
+        try:
+            warm_up()
+            warm_up_future.set_result(None)
+        except Exception as e:
+            warm_up_future.set_exception(e)
+
+    Thread(target=run, name='warm-up', daemon=True).start()
+
+async def wait_warm_up():
+    """Дочекатися фонового warm_up; оновлення не обробляються, доки post_init не завершився"""
+    if warm_up_future is None:
+        return
+    with startup_phase('wait_warm_up'):
+        try:
+            await asyncio.wrap_future(warm_up_future)
+        except Exception as e:
+            print(f"❌ Помилка прогріву: {e}")
+
+def build_application(token, with_updater=True):
+    """Application з усіма хендлерами; воркеру шардованого режиму updater не потрібен"""
+    global persistence, trace_exporter
+    persistence = PostgresPersistence(PERSISTENCE_INTERVAL)
+    if TRACE_EXPORT_FILE and trace_exporter is None:
+        # Воркери шардованого режиму пишуть кожен у свій файл
+        trace_exporter = ChromeTraceExporter(TRACE_EXPORT_FILE if PROCESS_ROLE != 'worker' else f'{TRACE_EXPORT_FILE}.{WORKER_INDEX}')
+    builder = (Application.builder().application_class(TracedApplication).token(token).base_url(f'{BOT_API_URL}/bot')
+               .request(InstrumentedRequest(connection_pool_size=256)).persistence(persistence))
+    if not with_updater:
+        builder = builder.updater(None)
+    if BOT_CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES))
+    app = builder.build()
     
-    Thread(target=run_http, daemon=True).start()
-    app = Application.builder().token(TOKEN).build()
+    http_server = None
     
     # Налаштовуємо команди для меню
     async def post_init(application: Application):
-        from telegram import BotCommand
-        await application.bot.set_my_commands([
-            BotCommand("start", "🏠 Головне меню"),
-            BotCommand("checkin", "✅ Check-in"),
-            BotCommand("checkout", "🚪 Check-out"),
-        ])
-        # Запускаємо планувальник скидання статусів о півночі
-        asyncio.create_task(schedule_midnight_reset(application))
+        nonlocal http_server
+        if PROCESS_ROLE == 'single':
+            # Health/readiness (і webhook, якщо увімкнено) на порту PORT; /readyz - 503, поки кеші не прогріті
+            http_server = await start_http_server(application)
+            await asyncio.gather(application.bot.set_my_commands(BOT_COMMANDS), wait_warm_up())
+        else:
+            await wait_warm_up()
+        # Черга вихідних викликів Telegram і фоновий пакетний запис статусів
+        outbound.start()
+        status_writer.start()
+        # Планувальник скидання статусів за розкладом чатів
+        reset_scheduler.start()
+        # Нагадування і автоматичний check-out
+        reminders.start(application.bot)
+        # Закріплені списки команди, створені до перезапуску
+        live_roster.start(application.bot)
+        # Зміни бібліотеки з інших процесів і ручні правки в БД
+        library_listener.start()
+        # Періодична звірка індексу команди з БД
+        asyncio.create_task(schedule_roster_reconcile())
+        if not is_ready():
+            asyncio.create_task(retry_warm_up())
+        startup_phases['ready'] = monotonic() - STARTED_AT
+        print(f"⏱ Готовий до оновлень за {startup_phases['ready'] * 1000:.0f} мс від старту процесу")
+    
+    async def post_stop(application: Application):
+        # Доотправляємо чергу, поки HTTP-клієнт бота ще відкритий
+        await outbound.stop()
+    
+    async def post_shutdown(application: Application):
+        if http_server:
+            http_server.close()
+        library_listener.stop()
+        # Дописуємо відкладені статуси, потім закриваємо пул з'єднань і потоки БД
+        await status_writer.stop()
+        print(f"📝 Запис статусів: {status_writer.stats()}")
+        db_executor.shutdown(wait=True)
+        db_pool.close()
+        if trace_exporter:
+            trace_exporter.close()
     
     app.post_init = post_init
+    app.post_stop = post_stop
+    app.post_shutdown = post_shutdown
     
     # ВАЖЛИВО: Додаємо обробник видалення команд ПЕРШИМ (найвищий пріоритет)
     app.add_handler(MessageHandler(filters.COMMAND, delete_commands), group=-1)
     
     conv = ConversationHandler(
         entry_points=[
-            CallbackQueryHandler(start_add_checkin, pattern='^add_checkin$'), 
-            CallbackQueryHandler(start_add_checkout, pattern='^add_checkout$')
+            CallbackQueryHandler(start_add_checkin, pattern=lambda data: data == callback_data('add_checkin')), 
+            CallbackQueryHandler(start_add_checkout, pattern=lambda data: data == callback_data('add_checkout'))
         ], 
         states={
             ADDING_CHECKIN_MEDIA: [
@@ -789,15 +4003,40 @@ def main():
                 CommandHandler("skip", name_checkout_media)
             ]
         }, 
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name='add_media',
+        persistent=True
     )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("checkin", checkin_command))
     app.add_handler(CommandHandler("checkout", checkout_command))
+    app.add_handler(CommandHandler("in", quick_checkin))
+    app.add_handler(CommandHandler("out", quick_checkout))
+    app.add_handler(CommandHandler("report", report))
+    app.add_handler(CommandHandler("resettime", reset_time_command))
     app.add_handler(conv)
-    app.add_handler(CallbackQueryHandler(buttons))
+    app.add_handler(CallbackQueryHandler(callbacks.dispatch))
+    app.add_handler(InlineQueryHandler(inline_query))
+    return app
+
+def main():
+    TOKEN = os.getenv('BOT_TOKEN')
+    if not TOKEN:
+        print("❌ BOT_TOKEN не знайдено!")
+        return
+    
+    if BOT_WORKERS > 1:
+        # Приймач оновлень + BOT_WORKERS процесів-обробників
+        asyncio.run(run_ingest(TOKEN, BOT_WORKERS))
+        return
+    
+    start_warm_up()
+    app = build_application(TOKEN)
     print("🤖 Бот запущено!")
-    app.run_polling(drop_pending_updates=True)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == '__main__':
     main()